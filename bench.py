@@ -0,0 +1,534 @@
+import os
+import sys
+import re
+import io
+import time
+import shutil
+import random
+import inspect
+import logging
+import argparse
+import asyncio
+import tempfile
+import resource
+import itertools
+import threading
+import subprocess
+import contextlib
+
+# قياس أداء bot.py بدون Telegram أو يوتيوب: عميل وهمي محلي، ومستخرجات وهمية تقدم وسائط مولدة بـ ffmpeg lavfi
+#   python bench.py --scenario link --jobs 50 --concurrency 8
+# إعدادات البوت (FETCH_WORKERS، GLOBAL_SEND_RATE...) تُمرر كمتغيرات بيئة كالمعتاد
+parser = argparse.ArgumentParser(description='Offline throughput benchmark for bot.py')
+parser.add_argument('--scenario', choices=['link', 'reel', 'file', 'compress', 'split', 'batch', 'all'], default='all')
+parser.add_argument('--jobs', type=int, default=20)
+parser.add_argument('--concurrency', type=int, default=4)
+parser.add_argument('--users', type=int, default=4, help='عدد المستخدمين الذين تتوزع عليهم المهام')
+parser.add_argument('--unique', type=int, default=0, help='عدد الروابط المختلفة (0 = رابط لكل مهمة)')
+parser.add_argument('--seconds', type=float, default=10, help='مدة الوسائط المولدة')
+parser.add_argument('--size', default='640x360')
+parser.add_argument('--codec', choices=['h264', 'mpeg4'], default='h264', help='mpeg4 يجبر مسار إعادة الترميز')
+parser.add_argument('--chunk-kb', type=int, default=1024, help='حجم الجزء في سيناريو split')
+parser.add_argument('--rpc-latency', type=float, default=0.0, help='تأخير كل طلب Telegram بالثواني')
+parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help='سرعة الرفع/التنزيل الوهمية (0 = بلا حد)')
+parser.add_argument('--extract-latency', type=float, default=0.05, help='تأخير استخراج المعلومات بالثواني')
+parser.add_argument('--output', help='إلحاق النتائج بملف (مثلاً bench_output.txt)')
+parser.add_argument('--keep', action='store_true', help='عدم حذف مجلد العمل المؤقت')
+args = parser.parse_args()
+
+if not shutil.which('ffmpeg') or not shutil.which('ffprobe'):
+    sys.exit("ffmpeg/ffprobe are required to generate the benchmark media")
+
+# البوت يُستورد من مجلد عمل مؤقت: قاعدة بيانات وdownloads/ وجلسة منفصلة
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='technosy-bench-')
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'bench')
+os.environ.setdefault('BOT_TOKEN', 'bench')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'cache.db')
+os.environ['STREAM_MODE'] = '0'
+os.environ['JOB_WORKERS'] = '0'
+os.environ.setdefault('JOB_CONCURRENCY', str(args.concurrency))
+os.chdir(WORKDIR)
+os.makedirs('downloads')
+sys.path.insert(0, ROOT)
+
+# bot أولاً حتى يقيس زمن استيراده الفعلي قبل أن تحمّل المحاكاة مكتباته الكسولة
+import bot
+import telegraph
+telegraph.Telegraph.create_account = lambda self, *a, **kw: {}
+import yt_dlp
+import instaloader
+import requests
+from telethon.tl.types import (Document, DocumentAttributeFilename, InputFile, InputFileBig, MessageMediaDocument)
+
+logging.getLogger().setLevel(logging.WARNING)
+MEDIA = {}
+
+def make_media(path, seconds, size, codec):
+    if codec == 'h264':
+        codecs = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac']
+    else:
+        codecs = ['-c:v', 'mpeg4', '-q:v', '5', '-c:a', 'mp2']
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=25:duration={seconds}',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                    *codecs, '-shortest', '-movflags', '+faststart', path], check=True)
+    return path
+
+# نقل وهمي: تأخير الطلب وزمن النقل حسب السرعة المحددة
+async def transfer(nbytes=0):
+    delay = args.rpc_latency
+    if args.bandwidth_mbps:
+        delay += nbytes * 8 / (args.bandwidth_mbps * 1e6)
+    await asyncio.sleep(delay)
+
+def copy_media(src, dst, hooks=(), chunk_size=1024 * 1024):
+    total = os.path.getsize(src)
+    done = 0
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while chunk := fin.read(chunk_size):
+            fout.write(chunk)
+            done += len(chunk)
+            if args.bandwidth_mbps:
+                time.sleep(len(chunk) * 8 / (args.bandwidth_mbps * 1e6))
+            for hook in hooks:
+                hook({'status': 'downloading', 'downloaded_bytes': done, 'total_bytes': total})
+    for hook in hooks:
+        hook({'status': 'finished', 'downloaded_bytes': done, 'total_bytes': total, 'filename': dst})
+
+# عميل Telegram وهمي: يسجل الرسائل ويقرأ الملفات المرفوعة فعلياً بدون شبكة
+class FakeMessage:
+    def __init__(self, client, chat_id, text='', media=None, buttons=None):
+        self.client = client
+        self.id = next(client.ids)
+        self.chat_id = chat_id
+        self.text = text or ''
+        self.media = media
+        self.buttons = buttons
+        self.deleted = False
+
+    async def edit(self, text=None, **kwargs):
+        await transfer()
+        self.text = text or self.text
+        self.buttons = kwargs.get('buttons')
+        self.client.log(self.chat_id, self.text)
+        return self
+
+    async def delete(self):
+        await transfer()
+        self.deleted = True
+
+class FakeClient:
+    flood_sleep_threshold = 5
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.texts = {}
+        self.messages = {}
+        self.uploaded_bytes = 0
+
+    def log(self, chat_id, text):
+        self.texts.setdefault(chat_id, []).append(text)
+
+    # رسائل الفشل تبدأ بـ ❌؛ عدادات التقدم (✅ n | ❌ m) ليست فشلاً
+    def failed(self, chat_id):
+        return any(str(text).startswith('❌') for text in self.texts.get(chat_id, []))
+
+    def _record(self, msg):
+        self.messages.setdefault(msg.chat_id, []).append(msg)
+        self.log(msg.chat_id, msg.text)
+        return msg
+
+    async def __call__(self, request):
+        await transfer(len(getattr(request, 'bytes', b'')))
+        self.uploaded_bytes += len(getattr(request, 'bytes', b''))
+        return True
+
+    async def upload_file(self, file, *, part_size_kb=None, file_name=None, progress_callback=None, **kwargs):
+        part_size = int((part_size_kb or 512) * 1024)
+        if isinstance(file, (bytes, bytearray)):
+            stream, name = io.BytesIO(file), file_name or 'file'
+        elif isinstance(file, str):
+            stream, name = open(file, 'rb'), os.path.basename(file)
+        else:
+            stream, name = file, file_name or getattr(file, 'name', 'file')
+        try:
+            size = stream.seek(0, io.SEEK_END)
+            stream.seek(0)
+            done = parts = 0
+            while chunk := stream.read(part_size):
+                done += len(chunk)
+                parts += 1
+                await transfer(len(chunk))
+                if progress_callback:
+                    result = progress_callback(done, size)
+                    if inspect.isawaitable(result):
+                        await result
+        finally:
+            if stream is not file:
+                stream.close()
+        self.uploaded_bytes += done
+        file_id = random.getrandbits(63)
+        if size > 10 * 1024 * 1024:
+            return InputFileBig(file_id, parts, str(name))
+        return InputFile(file_id, parts, str(name), '')
+
+    async def send_file(self, chat, file, caption=None, **kwargs):
+        if isinstance(file, (list, tuple)):
+            captions = caption if isinstance(caption, (list, tuple)) else [caption] * len(file)
+            return [await self.send_file(chat, f, caption=c, **kwargs) for f, c in zip(file, captions)]
+        await transfer()
+        document = Document(id=random.getrandbits(63), access_hash=random.getrandbits(63), file_reference=b'bench',
+                            date=None, mime_type='video/mp4', size=0, dc_id=1,
+                            attributes=[DocumentAttributeFilename(getattr(file, 'name', 'file'))])
+        return self._record(FakeMessage(self, chat, caption, MessageMediaDocument(document=document)))
+
+    async def send_message(self, chat, text, buttons=None, **kwargs):
+        await transfer()
+        return self._record(FakeMessage(self, chat, text, buttons=buttons))
+
+    async def edit_message(self, chat, message, text=None, **kwargs):
+        await transfer()
+        self.log(chat, text or '')
+
+    async def delete_messages(self, chat, message_ids, **kwargs):
+        await transfer()
+
+    async def download_file(self, location, file=None, **kwargs):
+        return await self.download_media(None, file, **kwargs)
+
+    async def get_messages(self, chat, ids=None, **kwargs):
+        await transfer()
+        return None
+
+    async def download_media(self, message, file=None, **kwargs):
+        source = MEDIA['upload']
+        path = file or os.path.basename(source)
+        if not os.path.splitext(path)[1]:
+            path += os.path.splitext(source)[1]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        await asyncio.get_running_loop().run_in_executor(None, copy_media, source, path)
+        return path
+
+class FakeEvent:
+    def __init__(self, client, sender_id, chat_id, text='', media=None, data=None):
+        self.client = client
+        self.sender_id = sender_id
+        self.chat_id = chat_id
+        self.raw_text = text
+        self.message = FakeMessage(client, chat_id, text, media)
+        self.data = data
+        self.pattern_match = None
+
+    async def reply(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    respond = reply
+
+    async def answer(self, *args, **kwargs):
+        await transfer()
+
+    async def edit(self, text, **kwargs):
+        return await self.message.edit(text, **kwargs)
+
+# yt-dlp وهمي: معلومات ثابتة لكل رابط، و"التحميل" نسخ للوسائط المولدة مع استدعاء progress_hooks
+def media_info(url):
+    video_id = re.split(r'[=/]', url.rstrip('/'))[-1]
+    vcodec, acodec = ('avc1.64001f', 'mp4a.40.2') if args.codec == 'h264' else ('mp4v.20.9', 'mp4a.6b')
+    width, height = (int(x) for x in args.size.split('x'))
+    size = os.path.getsize(MEDIA['video'])
+    fmt = {'format_id': '18', 'ext': 'mp4', 'vcodec': vcodec, 'acodec': acodec, 'width': width, 'height': height,
+           'filesize': size, 'tbr': size * 8 / 1000 / args.seconds, 'url': MEDIA['video']}
+    return {'id': video_id, 'title': f'Bench {video_id}', 'ext': 'mp4', 'duration': args.seconds, 'width': width,
+            'height': height, 'webpage_url': url, 'uploader': 'bench', 'formats': [fmt], **fmt}
+
+class FakeYoutubeDL:
+    def __init__(self, params=None, *a, **kw):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def sanitize_info(info, remove_private_keys=False):
+        return dict(info)
+
+    def extract_info(self, url, download=True, process=True, **kwargs):
+        time.sleep(args.extract_latency)
+        if url.startswith('ytsearch'):
+            count, query = re.match(r'ytsearch(\d*):(.*)', url).groups()
+            entries = [media_info(f'https://www.youtube.com/watch?v={abs(hash((query, i))) % 10 ** 8}')
+                       for i in range(int(count or 1))]
+            return {'_type': 'playlist', 'entries': entries}
+        info = media_info(url)
+        return self.process_ie_result(info, download) if download else info
+
+    def prepare_filename(self, info):
+        template = self.params.get('outtmpl', '%(title)s [%(id)s].%(ext)s')
+        if isinstance(template, dict):
+            template = template.get('default')
+        return re.sub(r'%\((\w+)\)[-.#0-9 +]*[a-zA-Z]', lambda m: str(info.get(m.group(1), 'NA')), template)
+
+    def process_ie_result(self, info, download=True, **kwargs):
+        info = dict(info)
+        if download:
+            path = self.prepare_filename(info)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            copy_media(MEDIA['video'], path, self.params.get('progress_hooks') or ())
+            info['requested_downloads'] = [{'filepath': path}]
+        return info
+
+# Instaloader وهمي
+class FakePost:
+    def __init__(self, shortcode):
+        self.shortcode = shortcode
+        self.is_video = True
+        self.video_url = 'bench://' + MEDIA['video']
+        self.caption = f'Bench reel {shortcode}'
+
+    @classmethod
+    def from_shortcode(cls, context, shortcode):
+        time.sleep(args.extract_latency)
+        return cls(shortcode)
+
+class FakeInstaloader:
+    def __init__(self, **kwargs):
+        self.context = object()
+
+# خادم CDN وهمي: يخدم bench://<مسار> من القرص مع دعم Range وبسرعة محدودة لكل اتصال
+class ThrottledReader(io.BytesIO):
+    def read(self, size=-1):
+        chunk = super().read(size)
+        if args.bandwidth_mbps and chunk:
+            time.sleep(len(chunk) * 8 / (args.bandwidth_mbps * 1e6))
+        return chunk
+
+class LocalRangeAdapter(requests.adapters.BaseAdapter):
+    def send(self, request, **kwargs):
+        path = request.url[len('bench://'):]
+        size = os.path.getsize(path)
+        response = requests.Response()
+        response.request, response.url = request, request.url
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        start, end = (int(match.group(1)), int(match.group(2) or size - 1)) if match else (0, size - 1)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        response.status_code = 206 if match else 200
+        response.headers['Content-Length'] = str(len(body))
+        if match:
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response.raw = ThrottledReader(body)
+        return response
+
+    def close(self):
+        pass
+
+yt_dlp.YoutubeDL = FakeYoutubeDL
+instaloader.Instaloader = FakeInstaloader
+instaloader.Post = FakePost
+bot.client = FakeClient()
+bot.http_pool().mount('bench://', LocalRangeAdapter())
+
+# السيناريوهات: كل مهمة تعيد المحادثة التي تُفحص رسائلها للنجاح، ولكل مهمة محادثة خاصة بها
+chat_base = 10 ** 6
+
+def job_ids(i):
+    key = i % args.unique if args.unique else i
+    return 1000 + i % args.users, chat_base + i, f'bench{chat_base + key}'
+
+def button_data(buttons, prefix):
+    for button in itertools.chain.from_iterable(buttons or []):
+        data = getattr(button, 'data', None) or getattr(getattr(button, 'type', None), 'data', None)
+        if data and data.startswith(prefix):
+            return data
+    return None
+
+# المعالجات تسجل المهمة وتعود فوراً؛ ننتظر أن ينهيها عامل الطابور
+async def wait_jobs(chat_id):
+    while True:
+        async for db in bot.get_db():
+            async with db.execute("SELECT COUNT(*) FROM jobs WHERE chat_id=? AND state IN ('queued', 'running')",
+                                  (chat_id,)) as cursor:
+                (pending,) = await cursor.fetchone()
+        if not pending:
+            return
+        await asyncio.sleep(0.02)
+
+async def job_link(i):
+    user_id, chat_id, media_id = job_ids(i)
+    await bot.handle_message(FakeEvent(bot.client, user_id, chat_id, f'https://www.youtube.com/watch?v={media_id}'))
+    await wait_jobs(chat_id)
+    return chat_id
+
+async def job_reel(i):
+    user_id, chat_id, media_id = job_ids(i)
+    await bot.handle_message(FakeEvent(bot.client, user_id, chat_id, f'https://www.instagram.com/reel/{media_id}/'))
+    await wait_jobs(chat_id)
+    return chat_id
+
+async def job_file(i):
+    user_id, chat_id, _ = job_ids(i)
+    document = Document(id=random.getrandbits(63), access_hash=0, file_reference=b'', date=None, mime_type='video/mp4',
+                        size=os.path.getsize(MEDIA['upload']), dc_id=1, attributes=[DocumentAttributeFilename('bench.mp4')])
+    await bot.handle_message(FakeEvent(bot.client, user_id, chat_id, media=MessageMediaDocument(document=document)))
+    menu = next((m for m in bot.client.messages.get(chat_id, []) if m.buttons), None)
+    data = button_data(menu.buttons if menu else None, b'compress')
+    if data is None:
+        bot.client.log(chat_id, '❌ no compress button')
+        return chat_id
+    await bot.process_file_options(FakeEvent(bot.client, user_id, chat_id, data=data))
+    await wait_jobs(chat_id)
+    return chat_id
+
+async def job_compress(i):
+    _, chat_id, _ = job_ids(i)
+    output = f'downloads/compress_{i}.mp4'
+    try:
+        success, _ = await bot.compress_video(MEDIA['video'], output)
+        if not success:
+            bot.client.log(chat_id, '❌ compress failed')
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+    return chat_id
+
+async def job_split(i):
+    _, chat_id, _ = job_ids(i)
+    for part in bot.split_file(MEDIA['video'], args.chunk_kb * 1024):
+        with part:
+            await bot.client.upload_file(part, part_size_kb=bot.UPLOAD_PART_SIZE_KB)
+    return chat_id
+
+# رسالة واحدة بعدة روابط (مع تكرار) تُسلَّم كألبوم
+async def job_batch(i):
+    user_id, chat_id, media_id = job_ids(i)
+    text = ' '.join([f'https://www.youtube.com/watch?v={media_id}a', f'https://youtu.be/{media_id}b',
+                     f'https://www.youtube.com/watch?v={media_id}a&si=dup', f'https://www.instagram.com/reel/{media_id}/'])
+    await bot.handle_message(FakeEvent(bot.client, user_id, chat_id, text))
+    await wait_jobs(chat_id)
+    if len([m for m in bot.client.messages.get(chat_id, []) if m.media]) != 3:
+        bot.client.log(chat_id, '❌ album size mismatch')
+    return chat_id
+
+SCENARIOS = {'link': job_link, 'reel': job_reel, 'file': job_file, 'compress': job_compress, 'split': job_split,
+             'batch': job_batch}
+
+# أعلى استهلاك للقرص داخل downloads/ يُقاس بعينات دورية
+class DiskSampler(threading.Thread):
+    def __init__(self, root, interval=0.05):
+        super().__init__(daemon=True)
+        self.root = root
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        total = 0
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                with contextlib.suppress(OSError):
+                    total += os.path.getsize(os.path.join(dirpath, name))
+        self.peak = max(self.peak, total)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+def peak_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+async def run_scenario(name):
+    global chat_base
+    chat_base += 10 ** 6
+    job = SCENARIOS[name]
+    limiter = asyncio.Semaphore(args.concurrency)
+    latencies, failures = [], 0
+    stages_before = {stage: bot.metrics.summary('stage_seconds', stage=stage)
+                     for stage in ('extract', 'download', 'transcode', 'upload')}
+
+    async def run_one(i):
+        nonlocal failures
+        async with limiter:
+            start = time.perf_counter()
+            try:
+                chat_id = await job(i)
+                failed = bot.client.failed(chat_id)
+                if failed:
+                    logging.warning(f"{name} job {i} failed: {bot.client.texts[chat_id][-1]}")
+            except Exception as e:
+                logging.warning(f"{name} job {i} raised: {e!r}")
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            failures += failed
+
+    sampler = DiskSampler('downloads')
+    sampler.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(i) for i in range(args.jobs)))
+    wall = time.perf_counter() - start
+    sampler.stop()
+    await bot.db_writes.flush()
+    stages = []
+    for stage, (count_before, total_before) in stages_before.items():
+        count, total = bot.metrics.summary('stage_seconds', stage=stage)
+        if count > count_before:
+            stages.append(f"{stage}={(total - total_before) / (count - count_before):.3f}s")
+    return (f"scenario={name} jobs={args.jobs} concurrency={args.concurrency} users={args.users} "
+            f"ok={args.jobs - failures} failed={failures} wall={wall:.2f}s jobs/sec={args.jobs / wall:.2f} "
+            f"p50={percentile(latencies, 50):.3f}s p99={percentile(latencies, 99):.3f}s "
+            f"peak_rss={peak_rss_mb(resource.RUSAGE_SELF):.1f}MB "
+            f"peak_child_rss={peak_rss_mb(resource.RUSAGE_CHILDREN):.1f}MB "
+            f"disk_high_water={sampler.peak / (1024 * 1024):.1f}MB"
+            + (f" stages[{' '.join(stages)}]" if stages else ""))
+
+async def main():
+    os.makedirs('media')
+    MEDIA['video'] = make_media('media/source.mp4', args.seconds, args.size, args.codec)
+    MEDIA['upload'] = MEDIA['video']
+    async for db in bot.get_db():
+        await bot.init_db(db)
+        await bot.cache_store.load(db)
+    await bot.job_worker.start()
+    names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    header = (f"# {time.strftime('%Y-%m-%d %H:%M:%S')} media={args.seconds:g}s {args.size} {args.codec} "
+              f"rpc_latency={args.rpc_latency:g}s bandwidth={args.bandwidth_mbps:g}Mbps "
+              f"bot_import={bot.startup['import']:.3f}s")
+    results = [header]
+    print(header)
+    for name in names:
+        line = await run_scenario(name)
+        print(line)
+        results.append(line)
+    await bot.job_worker.stop()
+    await bot.close_db()
+    if args.output:
+        with open(os.path.join(ROOT, args.output) if not os.path.isabs(args.output) else args.output, 'a') as f:
+            f.write('\n'.join(results) + '\n')
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    finally:
+        os.chdir(ROOT)
+        if args.keep:
+            print(f"workdir: {WORKDIR}")
+        else:
+            shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -1,28 +1,58 @@
+import time
+# زمن الإقلاع يُقاس من أول سطر، قبل استيراد أي مكتبة
+BOOT_STARTED = time.perf_counter()
 import os
+import sys
 import asyncio
 import re
 import logging
 import shlex
 from telethon import TelegramClient, events, Button
-import yt_dlp
-import instaloader
-import ffmpeg
+from telethon.errors import (FileReferenceExpiredError, FileReferenceInvalidError, FileReferenceEmptyError,
+                             FileIdInvalidError, MediaEmptyError, MediaInvalidError, FloodWaitError, RPCError)
+from telethon.helpers import generate_random_long
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import (InputDocument, InputDocumentFileLocation, InputPhoto, InputFileBig, MessageMediaDocument, MessageMediaPhoto,
+                               DocumentAttributeVideo, DocumentAttributeAudio)
 from dotenv import load_dotenv
 import shutil
 import aiosqlite
-from slugify import slugify
-from pathlib import Path
-import aiofiles
-from asyncio import Queue, Semaphore
-from concurrent.futures import ProcessPoolExecutor
-import time
-from telegraph import Telegraph
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import io
+from collections import OrderedDict, deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import validators
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import subprocess
+import hashlib
+import contextlib
+import contextvars
+import functools
+import itertools
+import heapq
+import threading
+import bisect
+import json
+import mimetypes
+import signal
+import importlib
+import types
+
+# استيراد كسول: المكتبات الثقيلة تُحمّل عند أول وصول لسمة منها، فلا يدفع الإقلاع ثمن ما لا يُستخدم
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+yt_dlp = LazyModule('yt_dlp')
+instaloader = LazyModule('instaloader')
+ffmpeg = LazyModule('ffmpeg')
+requests = LazyModule('requests')
+telegraph_api = LazyModule('telegraph')
+google_credentials = LazyModule('google.oauth2.credentials')
+drive_discovery = LazyModule('googleapiclient.discovery')
+drive_http = LazyModule('googleapiclient.http')
+drive_errors = LazyModule('googleapiclient.errors')
+google_auth_httplib2 = LazyModule('google_auth_httplib2')
+httplib2 = LazyModule('httplib2')
 
 # إعداد التسجيل
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -35,14 +65,68 @@ bot_token = os.getenv('BOT_TOKEN')
 DEVELOPER_ID = int(os.getenv('DEVELOPER_ID', '0'))
 GOOGLE_CREDS = os.getenv('GOOGLE_CREDS_JSON')
 COOKIES_PATH = '/root/technosy/youtube_cookies.txt'
+DB_PATH = os.getenv('DB_PATH', 'cache.db')
+CACHE_BUDGET_MB = int(os.getenv('CACHE_BUDGET_MB', '500'))
+PLAYLIST_CONCURRENCY = int(os.getenv('PLAYLIST_CONCURRENCY', '2'))
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+SEARCH_TTL = int(os.getenv('SEARCH_TTL', '900'))
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', '25'))
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', '1'))
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '3'))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '3'))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', str(os.cpu_count() or 2)))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+STREAM_MODE = os.getenv('STREAM_MODE', '0') == '1'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+# طابور المهام: JOB_WORKERS=0 يشغل العامل داخل عملية البوت، وإلا تُشغَّل عمليات عمال منفصلة بـ WORKER_ID
+WORKER_ID = os.getenv('WORKER_ID')
+WORKER_NAME = f"worker-{WORKER_ID}" if WORKER_ID else 'main'
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '0'))
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', '6'))
+JOB_LEASE = int(os.getenv('JOB_LEASE', '60'))
+JOB_POLL_INTERVAL = 1
+MAX_JOB_ATTEMPTS = 3
+DRIVE_WORKERS = int(os.getenv('DRIVE_WORKERS', '2'))
+DRIVE_CHUNK_MB = int(os.getenv('DRIVE_CHUNK_MB', '8'))
+DRIVE_RETRIES = int(os.getenv('DRIVE_RETRIES', '5'))
+REEL_RANGE_PARTS = int(os.getenv('REEL_RANGE_PARTS', '4'))
+REEL_TTL = int(os.getenv('REEL_TTL', '1800'))
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', str(24 * 3600)))
+# حد خانات التحميل لكل منصة داخل العامل، مثلاً "youtube=1,tiktok=3"؛ الافتراضي يترك خانة واحدة على الأقل لبقية المنصات
+PLATFORM_LIMITS = dict((name.strip().lower(), int(limit)) for name, _, limit in
+                       (item.partition('=') for item in os.getenv('PLATFORM_LIMITS', '').split(',') if '=' in item))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '5'))
+BREAKER_COOLDOWN = int(os.getenv('BREAKER_COOLDOWN', '120'))
+# رسالة بعدة روابط: حتى BATCH_MAX رابطاً (حد ألبوم Telegram)، ينفذ منها BATCH_CONCURRENCY معاً
+BATCH_MAX = int(os.getenv('BATCH_MAX', '10'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '3'))
 
 # التحقق من الإعدادات الأساسية
 if not all([api_id, api_hash, bot_token]):
     logging.error("Missing API credentials! Check your .env file.")
     exit(1)
 
-# إعداد العميل
-client = TelegramClient('TechnoSyriaBot', api_id, api_hash)
+# إعداد العميل: لكل عامل جلسته الخاصة، ولا يستقبل التحديثات إلا البوت الرئيسي
+client = TelegramClient(f'TechnoSyriaBot-{WORKER_NAME}' if WORKER_ID else 'TechnoSyriaBot', api_id, api_hash,
+                        receive_updates=WORKER_ID is None)
+# انتظارات FloodWait الأطول من ثوانٍ قليلة يتولاها مُجدول الرسائل بدلاً من Telethon
+client.flood_sleep_threshold = 5
+
+# حدود الرفع: Telegram يقبل حتى 2GB للملف الواحد عبر MTProto
+MAX_UPLOAD_SIZE = 2000 * 1024 * 1024
+UPLOAD_PART_SIZE_KB = 512
+COMPRESS_TARGET_MB = 50
+# مهلة انتظار خيوط التحميل الملغاة حتى تتوقف قبل حذف ملفاتها
+CANCEL_GRACE = 30
+# أدنى معدل بت مقبول عند الضغط؛ ما يحتاج أقل من ذلك ليتسع تحت الحد يُرفض بدلاً من تجاوز الحد
+MIN_VIDEO_KBPS, MIN_AUDIO_KBPS = 48, 24
+PROBE_TTL = 1800
+YDL_BASE_OPTS = {
+    'quiet': True,
+    'cookiefile': COOKIES_PATH,
+    'http_headers': {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/91.0.4472.124'},
+}
 
 # أنماط الروابط المحسنة
 YT_PATTERN = r'https?://(?:www\.)?(youtube\.com|youtu\.be)/[^\s]+'
@@ -54,56 +138,498 @@ TWITTER_PATTERN = r'https?://(?:www\.)?(twitter\.com|x\.com)/[^\s]+'
 TELEGRAM_STORY_PATTERN = r'https?://t\.me/[^/]+/s/(\d+)'
 
 # المتغيرات العامة
-download_queue = Queue()
-stats = {'downloads': 0, 'errors': 0}
 banned_users = set()
 muted_users = set()
-semaphore = Semaphore(3)
-active_downloads = {}
-telegraph = Telegraph()
-telegraph.create_account(short_name='TechnoSyriaBot')
-
-# Google Drive مع التحقق
-drive_service = None
-if GOOGLE_CREDS and os.path.exists(GOOGLE_CREDS):
+
+# Google Drive مع التحقق: بيانات الاعتماد تُقرأ عند أول استخدام فقط، والخدمة تُبنى لكل خيط رفع
+@functools.lru_cache(maxsize=1)
+def drive_credentials():
+    if not (GOOGLE_CREDS and os.path.exists(GOOGLE_CREDS)):
+        return None
     try:
-        creds = Credentials.from_authorized_user_file(GOOGLE_CREDS)
-        drive_service = build('drive', 'v3', credentials=creds)
+        return google_credentials.Credentials.from_authorized_user_file(GOOGLE_CREDS)
     except Exception as e:
         logging.warning(f"Google Drive setup failed: {str(e)}")
+        return None
+
+# مخبأ في الذاكرة بحد أقصى للعناصر ومدة صلاحية
+class TTLCache:
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+# المقاييس: عدادات ومدرجات زمنية لكل مرحلة، تُعرض بصيغة Prometheus وفي /stats
+LATENCY_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self, prefix='technosy'):
+        self.prefix = prefix
+        self.active_jobs = 0
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self._histograms:
+            self._histograms[key] = Histogram()
+        self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    # مهمة كاملة: عدد النشطة الآن، والمدة، والنتيجة لكل منصة
+    @contextlib.contextmanager
+    def job(self, platform):
+        self.active_jobs += 1
+        start = time.monotonic()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            self.active_jobs -= 1
+            self.observe('job_seconds', time.monotonic() - start, platform=platform)
+            self.inc('jobs_total', platform=platform, status=status)
+
+    # المقاييس اللحظية تُحسب عند الطلب: دالة تعيد قيمة أو قاموس {الوسوم: القيمة}
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def total(self, name, **labels):
+        wanted = set(labels.items())
+        return sum(value for (key, key_labels), value in self._counters.items()
+                   if key == name and wanted <= set(key_labels))
+
+    def by_label(self, name, label, **labels):
+        wanted = set(labels.items())
+        totals = defaultdict(float)
+        for (key, key_labels), value in self._counters.items():
+            if key == name and wanted <= set(key_labels):
+                totals[dict(key_labels).get(label)] += value
+        return dict(totals)
+
+    def summary(self, name, **labels):
+        wanted = set(labels.items())
+        count = total = 0
+        for (key, key_labels), hist in self._histograms.items():
+            if key == name and wanted <= set(key_labels):
+                count += hist.count
+                total += hist.sum
+        return count, total
+
+    def _labels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        for name in sorted({key for key, _ in self._counters}):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for (key, labels), value in sorted(self._counters.items()):
+                if key == name:
+                    lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value:g}")
+        for name in sorted({key for key, _ in self._histograms}):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for (key, labels), hist in sorted(self._histograms.items()):
+                if key != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append(f"{self.prefix}_{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.prefix}_{name}_sum{self._labels(labels)} {hist.sum:g}")
+                lines.append(f"{self.prefix}_{name}_count{self._labels(labels)} {hist.count}")
+        for name, func in sorted(self._gauges.items()):
+            try:
+                values = func()
+            except Exception as e:
+                logging.warning(f"Gauge {name} failed: {str(e)}")
+                continue
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in sorted(values.items()):
+                lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    # جمع ناتج render() من عمليات أخرى في نسخة واحدة: العدادات والمقاييس اللحظية تُجمع، والمدرجات بمجموعها وعددها
+    def load(self, text):
+        kinds = {}
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                _, _, name, kind = line.split()
+                kinds[name] = kind
+                continue
+            match = METRIC_LINE.match(line)
+            if not match:
+                continue
+            name, labels, value = match.group(1), match.group(2) or '', float(match.group(3))
+            labels = tuple(sorted((k, re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), v))
+                                  for k, v in METRIC_LABEL.findall(labels)))
+            base, _, part = name.rpartition('_')
+            if kinds.get(base) == 'histogram':
+                if part in ('sum', 'count'):
+                    key = (base.removeprefix(f"{self.prefix}_"), labels)
+                    if key not in self._histograms:
+                        self._histograms[key] = Histogram()
+                    if part == 'sum':
+                        self._histograms[key].sum += value
+                    else:
+                        self._histograms[key].count += int(value)
+            elif name in kinds:
+                self._counters[(name.removeprefix(f"{self.prefix}_"), labels)] += value
+
+METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+metrics = Metrics()
+metrics.gauge('active_jobs', lambda: metrics.active_jobs)
+# مراحل الإقلاع: import حتى نهاية تحميل الوحدة، ready حتى الاتصال بـ Telegram وبدء العامل
+startup = {}
+metrics.gauge('startup_seconds', lambda: {(('phase', phase),): seconds for phase, seconds in startup.items()})
+
+# قاعدة البيانات: اتصال واحد طويل العمر بوضع WAL بدلاً من اتصال لكل طلب
+_db = None
+_db_lock = asyncio.Lock()
+DB_PRAGMAS = ('journal_mode=WAL', 'synchronous=NORMAL', 'temp_store=MEMORY', 'cache_size=-16000',
+              'mmap_size=268435456', 'busy_timeout=5000')
+
+async def open_db():
+    global _db
+    if _db is None:
+        async with _db_lock:
+            if _db is None:
+                # sqlite3 يعيد استخدام الاستعلامات المُحضّرة من ذاكرته
+                db = await aiosqlite.connect(DB_PATH, cached_statements=256)
+                for pragma in DB_PRAGMAS:
+                    await db.execute(f"PRAGMA {pragma}")
+                _db = db
+    return _db
 
-# قاعدة البيانات
 async def get_db():
     try:
-        db = await aiosqlite.connect('cache.db')
-        yield db
+        yield await open_db()
     except aiosqlite.Error as e:
         logging.error(f"Database error: {str(e)}")
         raise
-    finally:
-        await db.close()
+
+async def close_db():
+    global _db
+    await db_writes.flush()
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+# كتابات مؤجلة تُجمع في معاملة واحدة
+class WriteBuffer:
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self._pending = []
+        self._task = None
+
+    def add(self, sql, params):
+        self._pending.append((sql, params))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            async for db in get_db():
+                with metrics.timer('db_seconds', op='flush'):
+                    for sql, group in itertools.groupby(pending, key=lambda item: item[0]):
+                        await db.executemany(sql, [params for _, params in group])
+                    await db.commit()
+        except aiosqlite.Error as e:
+            logging.error(f"Failed to flush {len(pending)} writes: {str(e)}")
+
+db_writes = WriteBuffer()
 
 async def init_db(db):
-    await db.execute('''CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, file_path TEXT, timestamp REAL)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, file_path TEXT, timestamp REAL,
+                        size INTEGER DEFAULT 0, last_access REAL)''')
+    async with db.execute("PRAGMA table_info(cache)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    for column, kind in (('size', 'INTEGER DEFAULT 0'), ('last_access', 'REAL'), ('owner', 'TEXT')):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE cache ADD COLUMN {column} {kind}")
+    await db.execute('''CREATE TABLE IF NOT EXISTS media_cache (url TEXT, variant TEXT, part INTEGER, media_type TEXT,
+                        media_id INTEGER, access_hash INTEGER, file_reference BLOB, caption TEXT, timestamp REAL,
+                        PRIMARY KEY (url, variant, part))''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, chat_id INTEGER,
+                        sender_id INTEGER, reply_to INTEGER, status_id INTEGER, payload TEXT, state TEXT, stage TEXT,
+                        attempts INTEGER DEFAULT 0, worker TEXT, lease_until REAL, error TEXT, created REAL, updated REAL)''')
+    await db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, sender_id)")
+    await db.execute('''CREATE TABLE IF NOT EXISTS drive_uploads (file_path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                        session_uri TEXT, updated REAL)''')
+    await db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+    await db.execute('''CREATE TABLE IF NOT EXISTS uploads (doc_id INTEGER PRIMARY KEY, access_hash INTEGER,
+                        file_reference BLOB, size INTEGER, mime_type TEXT, chat_id INTEGER, msg_id INTEGER, created REAL)''')
     await db.commit()
 
-# تنظيف الملفات
+# مخبأ مراجع Telegram: إعادة إرسال الوسائط المرفوعة سابقاً بدون تحميل أو رفع
+def media_variant(quality='best', audio_only=False, to_gif=False, as_doc=False):
+    if audio_only:
+        variant = 'mp3'
+    elif to_gif:
+        variant = 'gif'
+    elif quality == 'best':
+        variant = 'compressed'
+    else:
+        variant = quality
+    return f"{variant}:doc" if as_doc else variant
+
+# طبقة قراءة في الذاكرة أمام media_cache، مع تخزين النتائج السلبية لفترة قصيرة
+media_refs = TTLCache(maxsize=20000, ttl=6 * 3600)
+media_misses = TTLCache(maxsize=20000, ttl=60)
+
+async def get_cached_media(db, url, variant):
+    key = (url, variant)
+    rows = media_refs.get(key)
+    if rows is None:
+        if key in media_misses:
+            metrics.inc('cache_requests_total', cache='media', result='miss')
+            return []
+        with metrics.timer('db_seconds', op='select'):
+            async with db.execute("SELECT media_type, media_id, access_hash, file_reference, caption FROM media_cache "
+                                  "WHERE url=? AND variant=? ORDER BY part", (url, variant)) as cursor:
+                rows = await cursor.fetchall()
+        if rows:
+            media_refs[key] = rows
+        else:
+            media_misses[key] = True
+    metrics.inc('cache_requests_total', cache='media', result='hit' if rows else 'miss')
+    return rows
+
+def forget_cached_media(url, variant):
+    media_refs.pop((url, variant))
+    # الحذف من القاعدة مؤجل في db_writes: القراءة التالية تُعامل كغياب بدلاً من إعادة المرجع القديم
+    media_misses[(url, variant)] = True
+    db_writes.add("DELETE FROM media_cache WHERE url=? AND variant=?", (url, variant))
+
+async def save_cached_media(db, url, variant, messages):
+    rows = []
+    for msg in messages:
+        if isinstance(msg.media, MessageMediaDocument) and msg.media.document:
+            media_type, media = 'document', msg.media.document
+        elif isinstance(msg.media, MessageMediaPhoto) and msg.media.photo:
+            media_type, media = 'photo', msg.media.photo
+        else:
+            return
+        rows.append((media_type, media.id, media.access_hash, media.file_reference, msg.text))
+    forget_cached_media(url, variant)
+    media_refs[(url, variant)] = rows
+    media_misses.pop((url, variant))
+    now = time.time()
+    for part, row in enumerate(rows):
+        db_writes.add("INSERT INTO media_cache (url, variant, part, media_type, media_id, access_hash, file_reference, "
+                      "caption, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (url, variant, part, *row, now))
+
+# مرجع لم يعد صالحاً (منتهي، محذوف، غير متاح): يُنسى ويُعاد الرفع بدلاً من إفشال المهمة
+STALE_MEDIA_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError, FileReferenceEmptyError, FileIdInvalidError,
+                      MediaEmptyError, MediaInvalidError)
+
+def media_ref(media_type, media_id, access_hash, file_reference):
+    media_cls = InputPhoto if media_type == 'photo' else InputDocument
+    return media_cls(id=media_id, access_hash=access_hash, file_reference=file_reference)
+
+# الأجزاء المتعددة تُرسل كألبومات؛ إذا فشل أحدها تُحذف الأجزاء المرسلة قبله حتى لا يتكرر شيء عند إعادة الرفع
+async def send_cached_media(db, chat, url, variant):
+    rows = await get_cached_media(db, url, variant)
+    if not rows:
+        return False
+    media = [media_ref(*row[:4]) for row in rows]
+    captions = [row[4] for row in rows]
+    if len(rows) == 1:
+        media, captions = media[0], captions[0]
+    sent = []
+    try:
+        if isinstance(media, list):
+            for start in range(0, len(media), 10):
+                sent += await outbox.send_file(chat, media[start:start + 10], caption=captions[start:start + 10],
+                                               parse_mode='markdown')
+        else:
+            await outbox.send_file(chat, media, caption=captions, parse_mode='markdown')
+        return True
+    except STALE_MEDIA_ERRORS as e:
+        logging.info(f"Cached media for {url} is stale ({type(e).__name__}), re-uploading")
+        for msg in sent:
+            await outbox.delete(msg)
+        forget_cached_media(url, variant)
+        return False
+
+# مخبأ القرص: ميزانية بالبايت وإخلاء الأقدم استخداماً (LRU) مع حساب تراكمي للحجم
+class CacheStore:
+    def __init__(self, budget, owner=WORKER_NAME):
+        self.budget = budget
+        self.owner = owner
+        self.total = 0
+        self._entries = OrderedDict()
+        self._pins = {}
+
+    @property
+    def paths(self):
+        return {file_path for file_path, _ in self._entries.values()}
+
+    async def load(self, db):
+        async with db.execute("SELECT url, file_path, size FROM cache WHERE COALESCE(owner, 'main')=? ORDER BY last_access",
+                              (self.owner,)) as cursor:
+            rows = await cursor.fetchall()
+        stale = []
+        for key, file_path, size in rows:
+            if not os.path.exists(file_path):
+                stale.append((key,))
+                continue
+            size = size or os.path.getsize(file_path)
+            self._entries[key] = (file_path, size)
+            self.total += size
+        if stale:
+            await db.executemany("DELETE FROM cache WHERE url=?", stale)
+            await db.commit()
+        self.evict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        file_path, _ = entry
+        if not os.path.exists(file_path):
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        self.pin(file_path)
+        db_writes.add("UPDATE cache SET last_access=? WHERE url=?", (time.time(), key))
+        return file_path
+
+    def put(self, key, file_path):
+        if key in self._entries:
+            self._drop(key, remove_file=self._entries[key][0] != file_path)
+        size = os.path.getsize(file_path)
+        self._entries[key] = (file_path, size)
+        self.total += size
+        self.pin(file_path)
+        now = time.time()
+        db_writes.add("INSERT OR REPLACE INTO cache (url, file_path, timestamp, size, last_access, owner) "
+                      "VALUES (?, ?, ?, ?, ?, ?)", (key, file_path, now, size, now, self.owner))
+        self.evict()
+
+    # الملفات قيد الإرسال محمية من الإخلاء حتى تُحرر
+    def pin(self, file_path):
+        self._pins[file_path] = self._pins.get(file_path, 0) + 1
+
+    def unpin(self, file_path):
+        count = self._pins.get(file_path, 0) - 1
+        if count > 0:
+            self._pins[file_path] = count
+        else:
+            self._pins.pop(file_path, None)
+        self.evict()
+
+    def _drop(self, key, remove_file=True):
+        file_path, size = self._entries.pop(key)
+        self.total -= size
+        if remove_file and file_path not in self._pins and os.path.exists(file_path):
+            os.remove(file_path)
+        db_writes.add("DELETE FROM cache WHERE url=? AND file_path=?", (key, file_path))
+
+    def evict(self):
+        for key in list(self._entries):
+            if self.total <= self.budget:
+                break
+            if self._entries[key][0] not in self._pins:
+                self._drop(key)
+
+# كل عملية عامل تدير حصتها من الميزانية وملفاتها فقط
+cache_store = CacheStore(CACHE_BUDGET_MB * 1024 * 1024 // max(1, JOB_WORKERS))
+
+# تنظيف الملفات اليتيمة (غير المسجلة في المخبأ) الأقدم من يوم
+def sweep_untracked(tracked, max_age=24*3600):
+    cutoff = time.time() - max_age
+    removed = 0
+    for root, _, names in os.walk("downloads"):
+        for name in names:
+            path = os.path.join(root, name)
+            with contextlib.suppress(OSError):
+                if path not in tracked and os.path.getmtime(path) < cutoff:
+                    removed += os.path.getsize(path)
+                    os.remove(path)
+    return removed
+
 async def periodic_cleanup():
     while True:
         await asyncio.sleep(3600)
-        total_size = sum(os.path.getsize(f) for f in Path("downloads").glob("**/*") if f.is_file()) / (1024 * 1024)
-        if total_size > 500:
-            async for db in get_db():
-                async with db.execute("SELECT file_path, timestamp FROM cache WHERE timestamp < ?", 
-                                     (time.time() - 24*3600,)) as cursor:
-                    rows = await cursor.fetchall()
-                for row in rows:
-                    file_path, _ = row
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    await db.execute("DELETE FROM cache WHERE file_path = ?", (file_path,))
-                    await db.commit()
-            logging.info(f"Cleaned up {total_size:.2f}MB.")
+        cache_store.evict()
+        # الملفات المسجلة باسم أي عامل في جدول cache ليست يتيمة
+        tracked = cache_store.paths
+        async for db in get_db():
+            async with db.execute("SELECT file_path FROM cache") as cursor:
+                tracked |= {row[0] for row in await cursor.fetchall()}
+        db_writes.add("DELETE FROM jobs WHERE state IN ('done', 'failed', 'cancelled') AND updated < ?",
+                      (time.time() - 7 * 24 * 3600,))
+        # جلسات Drive تنتهي صلاحيتها بعد أسبوع
+        db_writes.add("DELETE FROM drive_uploads WHERE updated < ?", (time.time() - 7 * 24 * 3600,))
+        # نسخ الملفات المرفوعة على القرص تُحذف مع الملفات اليتيمة بعد انتهاء صلاحيتها
+        db_writes.add("DELETE FROM uploads WHERE created < ?", (time.time() - UPLOAD_TTL,))
+        removed = await asyncio.get_running_loop().run_in_executor(None, sweep_untracked, tracked)
+        logging.info(f"Cleaned up {removed / (1024 * 1024):.2f}MB of orphaned files.")
 
 # التحقق من المتطلبات
 def check_ffmpeg():
@@ -115,6 +641,524 @@ def validate_url(url):
 def check_cookies():
     return os.path.exists(COOKIES_PATH)
 
+# توحيد الروابط لمفاتيح المخبأ ودمج الطلبات
+TRACKING_PARAMS = {'si', 'feature', 'pp', 'igshid', 'igsh', 'fbclid', 'ref', 'ref_src', 's'}
+
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        host = host.removeprefix(prefix)
+    path = parsed.path.rstrip('/') or '/'
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k not in TRACKING_PARAMS and not k.startswith('utm_')]
+    if host == 'youtu.be':
+        host, path, query = 'youtube.com', '/watch', [('v', path.lstrip('/'))] + query
+    elif host == 'youtube.com' and path.startswith('/shorts/'):
+        path, query = '/watch', [('v', path.split('/')[2])] + query
+    return urlunparse(('https', host, path, '', urlencode(sorted(query)), ''))
+
+# دمج الطلبات المتطابقة الجارية: تنزيل واحد مشترك لكل مفتاح.
+# الدمج داخل العملية فقط: مع JOB_WORKERS > 0 قد ينزّل عاملان نفس الرابط معاً، ويلتقي الثاني بالأول عبر جدول cache
+# أو media_cache بعد انتهائه فقط. الحجز من جدول jobs لا يوجه المفاتيح المتطابقة إلى عامل بعينه
+class _Flight:
+    def __init__(self, task, progress):
+        self.task = task
+        self.progress = progress
+        self.waiters = 0
+        self.lock = asyncio.Lock()
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    # المهمة المشتركة تعمل في سياق نظيف لا يرث مهمة القائد ولا تقدمه: func تستلم مُبلّغ طوابير مشتركاً،
+    # والتقدم ومراحل المهام تصل عبر FlightProgress إلى كل منتظر ما دام منضماً
+    @contextlib.asynccontextmanager
+    async def join(self, key, func, cleanup=None, on_wait=None):
+        flight = self._flights.get(key)
+        if flight is None:
+            progress = FlightProgress()
+            context = contextvars.Context()
+            context.run(current_progress.set, progress)
+            context.run(current_platform.set, current_platform.get())
+            task = asyncio.create_task(func(progress.on_wait), context=context)
+            flight = self._flights[key] = _Flight(task, progress)
+        waiter = (current_job.get(), current_progress.get(), on_wait)
+        flight.progress.waiters.append(waiter)
+        flight.waiters += 1
+        try:
+            await asyncio.shield(flight.task)
+            yield flight
+        finally:
+            flight.progress.waiters.remove(waiter)
+            flight.waiters -= 1
+            if flight.waiters == 0:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if not flight.task.done():
+                    flight.task.cancel()
+                elif cleanup and not flight.task.cancelled() and flight.task.exception() is None:
+                    cleanup(flight.task.result())
+
+inflight = SingleFlight()
+
+probe_cache = TTLCache(maxsize=512, ttl=PROBE_TTL)
+
+# جدولة المهام: مراحل مستقلة (تحميل / معالجة / رفع) بطابور عادل بين المستخدمين
+class FairStage:
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self.active = 0
+        self._queues = OrderedDict()
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def position(self, fut):
+        # ترتيب الخدمة الفعلي: جولة واحدة لكل مستخدم بالتناوب
+        order, depth = [], 0
+        while len(order) < self.waiting:
+            order += [q[depth] for q in self._queues.values() if len(q) > depth]
+            depth += 1
+        return order.index(fut) + 1
+
+    def _pop_next(self):
+        user_id, queue = next(iter(self._queues.items()))
+        fut = queue.popleft()
+        del self._queues[user_id]
+        if queue:
+            self._queues[user_id] = queue
+        return fut
+
+    async def acquire(self, user_id, on_wait=None):
+        if self.active < self.slots and not self._queues:
+            self.active += 1
+            note_job_stage(self.name)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(fut)
+        if on_wait:
+            await on_wait(self, self.position(fut))
+        start = time.monotonic()
+        try:
+            await fut
+            metrics.observe('queue_wait_seconds', time.monotonic() - start, stage=self.name)
+            note_job_stage(self.name)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            elif user_id in self._queues and fut in self._queues[user_id]:
+                self._queues[user_id].remove(fut)
+                if not self._queues[user_id]:
+                    del self._queues[user_id]
+            raise
+
+    def release(self):
+        while self._queues:
+            fut = self._pop_next()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, on_wait=None):
+        await self.acquire(user_id, on_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+class Scheduler:
+    def __init__(self, fetch, transcode, upload):
+        self.fetch = FairStage('fetch', fetch)
+        self.transcode = FairStage('transcode', transcode)
+        self.upload = FairStage('upload', upload)
+
+    @property
+    def stages(self):
+        return (self.fetch, self.transcode, self.upload)
+
+scheduler = Scheduler(FETCH_WORKERS, TRANSCODE_WORKERS, UPLOAD_WORKERS)
+metrics.gauge('stage_waiting', lambda: {(('stage', s.name),): s.waiting for s in scheduler.stages})
+metrics.gauge('stage_active', lambda: {(('stage', s.name),): s.active for s in scheduler.stages})
+metrics.gauge('inflight_keys', lambda: len(inflight._flights))
+STAGE_NAMES = {'fetch': 'التحميل', 'transcode': 'المعالجة', 'upload': 'الرفع'}
+
+# قاطع دائرة لكل منصة: بعد BREAKER_THRESHOLD فشلاً متتالياً تُرفض مهامها فوراً لمدة BREAKER_COOLDOWN،
+# ثم تُجرب من جديد ويعيد أول فشل فتحه
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+    @property
+    def retry_after(self):
+        return max(0, int(self.open_until - time.monotonic()))
+
+    def check(self):
+        if self.retry_after:
+            metrics.inc('circuit_rejections_total', platform=self.name)
+            raise RuntimeError(f"{self.name} يواجه مشاكل حالياً، حاول بعد {self.retry_after} ثانية!")
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            metrics.inc('circuit_trips_total', platform=self.name)
+            logging.warning(f"Circuit for {self.name} open for {self.cooldown}s after {self.failures} failures")
+
+# ما يُحسب على المنصة: انقطاع الشبكة أو تعطل المستخرج فقط. المحتوى الخاص أو المحذوف أو المحجوب جغرافياً خطأ في الرابط،
+# وفشل إرسال Telegram أو الترميز لا علاقة له بالمنصة
+UNAVAILABLE_MARKERS = ('private', 'unavailable', 'not available', 'removed', 'deleted', 'not found', 'does not exist',
+                       'geo restrict', 'geo-restrict', 'in your country', 'confirm your age', 'age-restricted',
+                       'members-only', 'copyright', 'terminated', 'http error 404', 'http error 410', 'unsupported url')
+
+def platform_fault(error):
+    if isinstance(error, (ValueError, RPCError)):
+        return False
+    if 'yt_dlp' in sys.modules and isinstance(error, yt_dlp.utils.YoutubeDLError):
+        if isinstance(error, yt_dlp.utils.DownloadCancelled):
+            return False
+        message = str(error).lower()
+        return 'http error 5' in message or not any(marker in message for marker in UNAVAILABLE_MARKERS)
+    if 'instaloader' in sys.modules and isinstance(error, instaloader.exceptions.InstaloaderException):
+        return not isinstance(error, (instaloader.exceptions.QueryReturnedNotFoundException,
+                                      instaloader.exceptions.ProfileNotExistsException,
+                                      instaloader.exceptions.PrivateProfileNotFollowedException,
+                                      instaloader.exceptions.LoginRequiredException))
+    return isinstance(error, OSError)
+
+# محول لكل منصة: حد تزامن خاص بطابور عادل أمام خانات التحميل، وتوحيد الروابط لمفاتيح المخبأ، وقاطع دائرة.
+# منصة بطيئة أو محظورة تنتظر في طابورها الخاص بدلاً من حجز خانات التحميل المشتركة، والمعالجة والرفع لا يتقيدان بها
+current_platform = contextvars.ContextVar('current_platform', default=None)
+
+class PlatformAdapter:
+    def __init__(self, name, keep_query=None, aliases=None, playlist_query=()):
+        self.name = name
+        self.keep_query = keep_query
+        self.playlist_query = playlist_query
+        self.aliases = aliases or {}
+        self.stage = FairStage(name, PLATFORM_LIMITS.get(name.lower(), max(1, FETCH_WORKERS - 1)))
+        self.breaker = CircuitBreaker(name)
+
+    # للمفاتيح فقط (المخبأ، SingleFlight، إزالة التكرار)؛ معاملات القائمة تبقى في مفتاح القائمة كي لا تندمج قائمتان
+    def normalize(self, url, playlist=False):
+        parsed = urlparse(normalize_url(url))
+        query = parse_qsl(parsed.query)
+        if self.keep_query is not None:
+            keep = self.keep_query + (self.playlist_query if playlist else ())
+            query = [(k, v) for k, v in query if k in keep]
+        return urlunparse(('https', self.aliases.get(parsed.netloc, parsed.netloc), parsed.path, '', urlencode(query), ''))
+
+    # الإلغاء وما لا يحسبه platform_fault لا يغيران عداد القاطع
+    @contextlib.asynccontextmanager
+    async def run(self):
+        self.breaker.check()
+        reset = current_platform.set(self)
+        try:
+            yield
+        except Exception as e:
+            if platform_fault(e):
+                self.breaker.failure()
+            raise
+        finally:
+            current_platform.reset(reset)
+        self.breaker.success()
+
+PLATFORMS = {adapter.name.lower(): adapter for adapter in (
+    PlatformAdapter('YouTube', keep_query=('v',), playlist_query=('list',)),
+    PlatformAdapter('Instagram', keep_query=()),
+    PlatformAdapter('TikTok', keep_query=()),
+    PlatformAdapter('Facebook', keep_query=('v', 'story_fbid', 'id', 'fbid')),
+    PlatformAdapter('Twitter', keep_query=(), aliases={'x.com': 'twitter.com'}),
+    PlatformAdapter('Telegram', keep_query=()),
+)}
+metrics.gauge('circuit_open', lambda: {(('platform', a.name),): int(a.breaker.retry_after > 0) for a in PLATFORMS.values()})
+metrics.gauge('platform_active', lambda: {(('platform', a.name),): a.stage.active for a in PLATFORMS.values()})
+metrics.gauge('platform_waiting', lambda: {(('platform', a.name),): a.stage.waiting for a in PLATFORMS.values()})
+
+def platform_adapter(platform):
+    return PLATFORMS[platform.lower()]
+
+# خانة تحميل مشتركة، مسبوقة بخانة المنصة الجارية إن وُجدت
+@contextlib.asynccontextmanager
+async def fetch_slot(user_id, on_wait=None):
+    adapter = current_platform.get()
+    async with adapter.stage.slot(user_id, on_wait) if adapter else contextlib.nullcontext():
+        async with scheduler.fetch.slot(user_id, on_wait):
+            yield
+
+# موجّه الروابط: تعبير واحد مُجمّع بمجموعة مسماة لكل مسار (Reels قبل منشورات Instagram)،
+# والرسائل التي لا تحوي "http" لا تمر على أي تعبير
+ROUTES = (
+    ('reels', INSTA_REELS_PATTERN, 'Instagram'),
+    ('youtube', YT_PATTERN, 'YouTube'),
+    ('instagram', INSTA_PATTERN, 'Instagram'),
+    ('tiktok', TIKTOK_PATTERN, 'TikTok'),
+    ('facebook', FB_PATTERN, 'Facebook'),
+    ('twitter', TWITTER_PATTERN, 'Twitter'),
+    ('telegram', TELEGRAM_STORY_PATTERN, 'Telegram'),
+)
+URL_ROUTER = re.compile('|'.join(f'(?P<{route}>{pattern})' for route, pattern, _ in ROUTES))
+ROUTE_PLATFORMS = {route: platform for route, _, platform in ROUTES}
+
+def is_playlist_url(route, url):
+    return route == 'youtube' and ('playlist' in url.lower() or 'list=' in url)
+
+def route_urls(text):
+    if 'http' not in text:
+        return []
+    routes, seen = [], set()
+    for match in URL_ROUTER.finditer(text):
+        route, url = match.lastgroup, match.group()
+        key = platform_adapter(ROUTE_PLATFORMS[route]).normalize(url, playlist=is_playlist_url(route, url))
+        if key not in seen:
+            seen.add(key)
+            routes.append((route, url))
+    return routes
+
+# جدولة الرسائل الصادرة: دلو رموز عام ولكل محادثة، أولوية للوسائط، ودمج التعديلات المتتالية
+PRIORITY_MEDIA, PRIORITY_REPLY, PRIORITY_EDIT = 0, 1, 2
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class _Outgoing:
+    def __init__(self, priority, seq, chat, factory, key, final=False):
+        self.priority = priority
+        self.seq = seq
+        self.chat = chat
+        self.factory = factory
+        self.key = key
+        self.final = final
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    def __init__(self, rate, chat_rate):
+        self._global = TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._chats = {}
+        self._queue = []
+        self._edits = {}
+        self._busy = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+    def _bucket(self, chat):
+        if chat not in self._chats:
+            self._chats[chat] = TokenBucket(self._chat_rate, 3)
+        return self._chats[chat]
+
+    def _submit(self, priority, chat, factory, key=None, final=False):
+        if key is not None and key in self._edits:
+            # تعديل أحدث لنفس الرسالة يلغي السابق الذي لم يُرسل بعد، أما الحذف المعلق فيبتلع ما بعده
+            pending = self._edits[key]
+            if not pending.final:
+                pending.factory = factory
+                pending.final = final
+            return pending.future
+        item = _Outgoing(priority, next(self._seq), chat, factory, key, final)
+        if key is not None:
+            self._edits[key] = item
+        heapq.heappush(self._queue, item)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        return item.future
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            wait = None
+            global_delay = self._global.delay()
+            for item in sorted(self._queue):
+                if item.chat in self._busy:
+                    continue
+                delay = max(global_delay, self._bucket(item.chat).delay())
+                if delay == 0:
+                    self._queue.remove(item)
+                    heapq.heapify(self._queue)
+                    if item.key is not None:
+                        self._edits.pop(item.key, None)
+                    self._global.take()
+                    self._bucket(item.chat).take()
+                    self._busy.add(item.chat)
+                    asyncio.create_task(self._run(item))
+                    wait = 0
+                    break
+                wait = delay if wait is None else min(wait, delay)
+            if wait == 0:
+                continue
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+
+    async def _run(self, item):
+        try:
+            # المستدعي أُلغي قبل دوره (مثلاً /cancel أثناء انتظار رفع): لا يُرسل شيء
+            if item.future.cancelled():
+                return
+            result = await item.factory()
+        except FloodWaitError as e:
+            logging.warning(f"FloodWait {e.seconds}s for chat {item.chat}")
+            metrics.inc('flood_waits_total')
+            self._bucket(item.chat).block(e.seconds)
+            if item.key is not None and item.key in self._edits:
+                pending = self._edits[item.key]
+                if item.final and not pending.final:
+                    pending.factory = item.factory
+                    pending.final = True
+                if not item.future.done():
+                    item.future.set_result(None)
+            else:
+                if item.key is not None:
+                    self._edits[item.key] = item
+                heapq.heappush(self._queue, item)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._busy.discard(item.chat)
+            self._wakeup.set()
+
+    async def send_file(self, chat, file, **kwargs):
+        return await self._submit(PRIORITY_MEDIA, chat, lambda: client.send_file(chat, file, **kwargs))
+
+    async def send_message(self, chat, text, **kwargs):
+        return await self._submit(PRIORITY_REPLY, chat, lambda: client.send_message(chat, text, **kwargs))
+
+    async def reply(self, event, text, **kwargs):
+        return await self._submit(PRIORITY_REPLY, event.chat_id, lambda: event.reply(text, **kwargs))
+
+    # التعديلات والحذف تجميلية: لا ينتظرها المستدعي، وأخطاؤها تُسجل فقط
+    async def edit(self, msg, text, **kwargs):
+        future = self._submit(PRIORITY_EDIT, msg.chat_id, lambda: msg.edit(text, **kwargs), key=(msg.chat_id, msg.id))
+        future.add_done_callback(_log_outgoing_error)
+
+    async def delete(self, msg):
+        future = self._submit(PRIORITY_EDIT, msg.chat_id, msg.delete, key=(msg.chat_id, msg.id), final=True)
+        future.add_done_callback(_log_outgoing_error)
+
+def _log_outgoing_error(future):
+    if not future.cancelled() and future.exception():
+        logging.warning(f"Status update failed: {str(future.exception())}")
+
+outbox = Outbox(GLOBAL_SEND_RATE, CHAT_SEND_RATE)
+metrics.gauge('outbox_queued', lambda: len(outbox._queue))
+
+# تقدم المهمة الحي: تحديثات مُجمّعة لرسالة الحالة (مرة كل بضع ثوانٍ على الأكثر) مع السرعة والوقت المتبقي
+current_progress = contextvars.ContextVar('current_progress', default=None)
+
+class JobProgress:
+    LABELS = {'fetch': '⬇️ التحميل', 'transcode': '⚙️ المعالجة', 'upload': '⬆️ الرفع'}
+
+    def __init__(self, status_msg, interval=PROGRESS_INTERVAL):
+        self.status_msg = status_msg
+        self.interval = interval
+        self.stage = None
+        self.rate = 0
+        self._mark = (0, 0)
+        self._last_edit = 0
+
+    def update(self, stage, done, total=None, unit='bytes'):
+        now = time.monotonic()
+        if stage != self.stage:
+            self.stage, self.rate, self._mark = stage, 0, (now, done)
+        elif now - self._mark[0] >= 1:
+            # متوسط متحرك للسرعة بين التحديثات
+            rate = (done - self._mark[1]) / (now - self._mark[0])
+            self.rate = rate if not self.rate else 0.7 * self.rate + 0.3 * rate
+            self._mark = (now, done)
+        if now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        parts = [f"**{self.LABELS[stage]}:**"]
+        if total:
+            ratio = min(done / total, 1)
+            bar = '█' * int(ratio * 10) + '░' * (10 - int(ratio * 10))
+            parts.append(f"{ratio:.0%} [{bar}]")
+        if unit == 'bytes':
+            parts.append(f"{done / (1024 * 1024):.1f}" + (f"/{total / (1024 * 1024):.1f}" if total else "") + "MB")
+            if self.rate:
+                parts.append(f"• {self.rate / (1024 * 1024):.2f}MB/s")
+        elif self.rate:
+            parts.append(f"• {self.rate:.1f}x")
+        if total and self.rate > 0:
+            parts.append(f"• ⏱ {int((total - done) / self.rate)}s")
+        asyncio.ensure_future(outbox.edit(self.status_msg, ' '.join(parts) + " ⏳"))
+
+    def from_thread(self, loop):
+        return lambda *args, **kwargs: loop.call_soon_threadsafe(functools.partial(self.update, *args, **kwargs))
+
+    def upload_callback(self, current, total):
+        self.update('upload', current, total)
+
+    def download_callback(self, current, total):
+        self.update('fetch', current, total)
+
+# تقدم مهمة مدمجة في SingleFlight: يُوزَّع على المنتظرين المنضمين فقط، فمن غادر أو أُلغي لا تصل رسالته أي تحديثات
+class FlightProgress(JobProgress):
+    def __init__(self):
+        self.waiters = []
+
+    @property
+    def job_ids(self):
+        return [job_id for job_id, _, _ in self.waiters if job_id is not None]
+
+    def update(self, *args, **kwargs):
+        for _, progress, _ in list(self.waiters):
+            if progress:
+                progress.update(*args, **kwargs)
+
+    async def on_wait(self, stage, position):
+        for _, _, notify in list(self.waiters):
+            if notify:
+                await notify(stage, position)
+
+def queue_notifier(status_msg):
+    async def notify(stage, position):
+        with contextlib.suppress(Exception):
+            await outbox.edit(status_msg, f"🕒 **في طابور {STAGE_NAMES.get(stage.name, stage.name)}:** موقعك {position} ⏳")
+    return notify
+
 # أمر /start
 @client.on(events.NewMessage(pattern='/start'))
 async def start_command(event):
@@ -130,7 +1174,7 @@ async def start_command(event):
         [Button.inline("📹 يوتيوب", "yt_help"), Button.inline("📸 إنستغرام", "insta_help")],
         [Button.inline("⚙️ أدوات", "tools_help"), Button.inline("ℹ️ الحالة", "status")]
     ]
-    await event.reply(welcome_msg, buttons=buttons, parse_mode='markdown')
+    await outbox.reply(event, welcome_msg, buttons=buttons, parse_mode='markdown')
 
 # أوامر إضافية
 @client.on(events.NewMessage(pattern='/help'))
@@ -142,22 +1186,67 @@ async def help_command(event):
         "🔹 `/yt [اسم]` - بحث ذكي في يوتيوب.\n"
         "🔹 `/cancel` - إيقاف أي عملية."
     )
-    await event.reply(msg, parse_mode='markdown')
+    await outbox.reply(event, msg, parse_mode='markdown')
 
 @client.on(events.NewMessage(pattern='/stats'))
 async def stats_command(event):
-    total_size = sum(os.path.getsize(f) for f in Path("downloads").glob("**/*") if f.is_file()) / (1024 * 1024)
-    msg = f"📊 **إحصائيات البوت**\n🔹 تحميلات: {stats['downloads']}\n🔹 أخطاء: {stats['errors']}\n🔹 حجم المؤقت: {total_size:.2f}MB"
-    await event.reply(msg, parse_mode='markdown')
+    # المخبأ والطابور من قاعدة البيانات المشتركة، والبقية من مقاييس الواجهة والعمال مجمعة
+    async for db in get_db():
+        async with db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache") as cursor:
+            cached_files, cached_bytes = await cursor.fetchone()
+        async with db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state") as cursor:
+            jobs = dict(await cursor.fetchall())
+    stats, missing = await cluster_metrics()
+    errors = stats.total('jobs_total', status='error') + stats.total('playlist_entry_errors_total')
+    msg = (f"📊 **إحصائيات البوت**\n🔹 تحميلات: {stats.total('deliveries_total'):.0f}\n🔹 أخطاء: {errors:.0f}\n"
+           f"🔹 حجم المؤقت: {cached_bytes / (1024 * 1024):.2f}MB ({cached_files} ملف)")
+    if event.sender_id == DEVELOPER_ID:
+        nodes = JOB_WORKERS or 1
+        msg += (f"\n\n📥 **طابور المهام:** {jobs.get('queued', 0)} بالانتظار | {jobs.get('running', 0)} قيد التنفيذ | "
+                f"{jobs.get('done', 0)} منتهية | {jobs.get('failed', 0)} فاشلة | {jobs.get('cancelled', 0)} ملغاة"
+                f"\n⚙️ **مهام نشطة:** {stats.total('active_jobs'):.0f} على {nodes} عامل")
+        if missing:
+            msg += f"\n⚠️ **تعذرت قراءة مقاييس {missing} عامل، الأرقام التالية ناقصة**"
+        msg += "\n⏱ **متوسط المراحل:**"
+        for stage in ('extract', 'download', 'transcode', 'upload', 'stream', 'drive'):
+            count, total = stats.summary('stage_seconds', stage=stage)
+            if count:
+                msg += f"\n🔹 {stage}: {total / count:.2f}s × {count}"
+        msg += "\n🕒 **الطوابير:**"
+        active = stats.by_label('stage_active', 'stage')
+        waiting = stats.by_label('stage_waiting', 'stage')
+        for stage in scheduler.stages:
+            count, total = stats.summary('queue_wait_seconds', stage=stage.name)
+            wait = f" | انتظار {total / count:.1f}s" if count else ""
+            msg += (f"\n🔹 {STAGE_NAMES[stage.name]}: {active.get(stage.name, 0):.0f}/{stage.slots * nodes} نشط | "
+                    f"{waiting.get(stage.name, 0):.0f} بالطابور{wait}")
+        active = stats.by_label('platform_active', 'platform')
+        waiting = stats.by_label('platform_waiting', 'platform')
+        tripped = stats.by_label('circuit_open', 'platform')
+        for adapter in PLATFORMS.values():
+            if active.get(adapter.name) or waiting.get(adapter.name) or tripped.get(adapter.name):
+                state = f" | 🔌 مفصول لدى {tripped[adapter.name]:.0f} عامل" if tripped.get(adapter.name) else ""
+                msg += (f"\n🔹 {adapter.name}: {active.get(adapter.name, 0):.0f}/{adapter.stage.slots * nodes} نشط | "
+                        f"{waiting.get(adapter.name, 0):.0f} بالطابور{state}")
+        hits = stats.by_label('cache_requests_total', 'cache', result='hit')
+        ratios = [f"{name} {hits.get(name, 0) / total:.0%}"
+                  for name, total in sorted(stats.by_label('cache_requests_total', 'cache').items())]
+        msg += f"\n🎯 **إصابة المخبأ:** {' | '.join(ratios) or '-'}"
+        moved = stats.by_label('bytes_total', 'direction')
+        msg += (f"\n📦 **البيانات:** ⬇️ {moved.get('download', 0) / (1024 * 1024):.1f}MB | "
+                f"⬆️ {moved.get('upload', 0) / (1024 * 1024):.1f}MB")
+        msg += "\n❌ **الأخطاء لكل منصة:**"
+        for platform, total in sorted(stats.by_label('jobs_total', 'platform').items()):
+            failed = stats.total('jobs_total', platform=platform, status='error')
+            msg += f"\n🔹 {platform}: {failed:.0f}/{total:.0f} ({failed / total:.0%})"
+    await outbox.reply(event, msg, parse_mode='markdown')
 
 @client.on(events.NewMessage(pattern='/cancel'))
 async def cancel_command(event):
-    if event.sender_id in active_downloads:
-        active_downloads[event.sender_id].cancel()
-        del active_downloads[event.sender_id]
-        await event.reply("🛑 **تم الإلغاء بنجاح!**\n@techno_syria_bot", parse_mode='markdown')
+    if await cancel_jobs(event.sender_id):
+        await outbox.reply(event, "🛑 **تم الإلغاء بنجاح!**\n@techno_syria_bot", parse_mode='markdown')
     else:
-        await event.reply("❌ **لا توجد عمليات نشطة!**\n@techno_syria_bot", parse_mode='markdown')
+        await outbox.reply(event, "❌ **لا توجد عمليات نشطة!**\n@techno_syria_bot", parse_mode='markdown')
 
 # مساعدة وحالة
 @client.on(events.CallbackQuery(pattern=r'(yt|insta|tools|status)_help'))
@@ -167,88 +1256,425 @@ async def help_handler(event):
         'yt': "📹 **يوتيوب**: تحميل فيديوهات بجودات متعددة (حتى 4K) مع خيارات تحويل!",
         'insta': "📸 **إنستغرام**: Reels تُحمل فوراً، بقية المنشورات بسرعة خارقة!",
         'tools': "⚙️ **أدوات البوت**:\n- **ضغط**: تصغير حجم الفيديو.\n- **MP3**: استخراج الصوت.\n- **GIF**: تحويل إلى صورة متحركة.\n- **Drive/Telegraph**: رفع الملفات!",
-        'status': f"ℹ️ **حالة البوت**\nFFmpeg: {'✅' if check_ffmpeg() else '❌'}\nDrive: {'✅' if drive_service else '❌'}\nCookies: {'✅' if check_cookies() else '❌'}\n@techno_syria_bot"
+        'status': f"ℹ️ **حالة البوت**\nFFmpeg: {'✅' if check_ffmpeg() else '❌'}\nDrive: {'✅' if drive_credentials() else '❌'}\nCookies: {'✅' if check_cookies() else '❌'}\n@techno_syria_bot"
     }
-    await event.reply(messages[platform], parse_mode='markdown')
-
-# تقسيم الملفات
-async def split_file(file_path, chunk_size=50*1024*1024):
-    file_size = os.path.getsize(file_path) / (1024 * 1024)
-    if file_size > 2000:
-        raise ValueError("الملف أكبر من 2GB!")
-    async with aiofiles.open(file_path, 'rb') as f:
-        content = await f.read()
-    parts = []
-    for i in range(0, len(content), chunk_size):
-        part_path = f"{file_path}.part{i//chunk_size}"
-        async with aiofiles.open(part_path, 'wb') as part_file:
-            await part_file.write(content[i:i + chunk_size])
-        parts.append(part_path)
-    return parts
-
-# تشغيل FFmpeg
-async def run_ffmpeg(cmd, timeout=300):
+    await outbox.reply(event, messages[platform], parse_mode='markdown')
+
+# قراءة مقطع من ملف دون نسخه إلى الذاكرة أو القرص
+class FileRange(io.RawIOBase):
+    def __init__(self, path, offset=0, length=None, name=None):
+        self._fd = os.open(path, os.O_RDONLY)
+        size = os.fstat(self._fd).st_size
+        self._offset = offset
+        self._length = size - offset if length is None else min(length, size - offset)
+        self._pos = 0
+        self.name = name or os.path.basename(path)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self._length - self._pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self._fd, n, self._offset + self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+# تقسيم الملفات: أجزاء تُقرأ من مواقعها في الملف الأصلي بدون ملفات مؤقتة
+def split_file(file_path, chunk_size=MAX_UPLOAD_SIZE):
+    file_size = os.path.getsize(file_path)
+    name = os.path.basename(file_path)
+    return [FileRange(file_path, offset, chunk_size, f"{name}.part{i}")
+            for i, offset in enumerate(range(0, file_size, chunk_size))]
+
+# إلغاء تعاوني: خيوط yt-dlp تتوقف عند الجزء التالي، وعمليات ffmpeg تُقتل بمجموعتها، والملفات الجزئية تُحذف
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.paths = set()
+        self.tags = set()
+        self.futures = set()
+        self.threads = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        # دمج yt-dlp يشغّل ffmpeg من الخيط نفسه خارج أي مجموعة عمليات نقتلها، والخطاف لا يُستدعى أثناءه:
+        # أبناء خيوطنا التي ما زالت تعمل تُقرأ من /proc وتُقتل، فيفشل الدمج وينتهي الخيط
+        if all(future.done() for future in self.futures):
+            return
+        for tid in self.threads:
+            with contextlib.suppress(OSError, ValueError):
+                with open(f"/proc/self/task/{tid}/children") as f:
+                    for pid in f.read().split():
+                        os.kill(int(pid), signal.SIGKILL)
+
+    # عمل في خيط يُنتظر قبل التنظيف: الخيط يواصل الكتابة حتى يرى الإلغاء، فإلغاء المنتظر لا يلغي مستقبله المتتبَّع
+    def run_in_thread(self, func):
+        future = asyncio.get_running_loop().run_in_executor(None, func)
+        self.futures.add(future)
+        return asyncio.shield(future)
+
+    # يُستدعى من خيط yt-dlp مع كل جزء ومع كل معالجة لاحقة
+    def hook(self, d):
+        self.threads.add(threading.get_native_id())
+        if self._event.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+
+    def track(self, path=None, tag=None):
+        if path:
+            self.paths.add(path)
+        if tag:
+            self.tags.add(tag)
+
+    def cleanup(self):
+        paths = {p for path in self.paths for p in (path, path + '.part')}
+        if self.tags:
+            with contextlib.suppress(OSError):
+                paths |= {os.path.join("downloads", name) for name in os.listdir("downloads")
+                          if any(tag in name for tag in self.tags)}
+        removed = 0
+        for path in paths - cache_store.paths:
+            with contextlib.suppress(OSError):
+                size = os.path.getsize(path)
+                os.remove(path)
+                removed += size
+        metrics.inc('reclaimed_bytes_total', removed)
+        return removed
+
+current_token = contextvars.ContextVar('current_token', default=None)
+
+# عند أي فشل أو إلغاء داخل النطاق: يُوقف العمل الجاري في الخيوط، ويُنتظر (بحماية من الإلغاء ولمدة CANCEL_GRACE)
+# حتى تتوقف فعلاً، ثم تُحذف ملفاتها فلا يبقى ما تكتبه بعد الحذف حتى التنظيف اليومي
+@contextlib.asynccontextmanager
+async def cancel_scope():
+    token = CancelToken()
+    reset = current_token.set(token)
+    try:
+        yield token
+    except BaseException:
+        token.cancel()
+        pending = [future for future in token.futures if not future.done()]
+        if pending:
+            with contextlib.suppress(asyncio.TimeoutError, asyncio.CancelledError):
+                await asyncio.wait_for(asyncio.shield(asyncio.gather(*pending, return_exceptions=True)),
+                                       timeout=CANCEL_GRACE)
+        token.cleanup()
+        raise
+    finally:
+        current_token.reset(reset)
+
+# العمليات تبدأ في جلسة جديدة فيقتل الإلغاء أبناءها أيضاً
+def kill_group(process):
+    if process.returncode is None:
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.killpg(process.pid, signal.SIGKILL)
+
+# تشغيل FFmpeg (يقبل سطر أوامر نصياً أو قائمة وسائط)؛ مع مدة معروفة يُقرأ التقدم من -progress
+async def run_ffmpeg(cmd, timeout=300, duration=None):
     if not check_ffmpeg():
         raise RuntimeError("FFmpeg غير مثبت!")
-    args = shlex.split(cmd)
+    args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+    progress = current_progress.get()
+    if progress and duration:
+        args[1:1] = ['-progress', 'pipe:1', '-nostats']
+
+    async def watch(stdout):
+        async for line in stdout:
+            key, _, value = line.decode(errors='ignore').strip().partition('=')
+            if progress and duration and key == 'out_time_us' and value.isdigit():
+                progress.update('transcode', int(value) / 1e6, duration, unit='seconds')
+
     try:
-        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                       start_new_session=True)
+        stderr_task = asyncio.create_task(process.stderr.read())
+        watch_task = asyncio.create_task(watch(process.stdout))
+        try:
+            with metrics.timer('stage_seconds', stage='transcode'):
+                await asyncio.wait_for(process.wait(), timeout=timeout)
+                await watch_task
+        except BaseException:
+            kill_group(process)
+            watch_task.cancel()
+            stderr_task.cancel()
+            raise
+        stderr = await stderr_task
         if process.returncode != 0:
             raise RuntimeError(f"FFmpeg فشل: {stderr.decode().strip()}")
         return True, ""
     except asyncio.TimeoutError:
-        process.kill()
         raise RuntimeError(f"FFmpeg تجاوز الوقت ({timeout} ثانية)!")
     except Exception as e:
         raise RuntimeError(str(e))
 
+# فحص الملف بـ ffprobe
+async def probe_media(path):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, lambda: ffmpeg.probe(path))
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"ffprobe فشل: {e.stderr.decode(errors='ignore').strip()}")
+
+def _stream(probe, codec_type):
+    return next((s for s in probe.get('streams', []) if s.get('codec_type') == codec_type), None)
+
+# ميزانية الضغط لمدة معينة: (معدل الفيديو، معدل الصوت، الارتفاع الناتج). الصوت والفيديو يُقسمان الميزانية معاً:
+# الصوت يتقلص مع المدة حتى حده الأدنى، والباقي للفيديو
+def compress_budget(duration, max_size_mb=COMPRESS_TARGET_MB, audio=True):
+    # 5% هامش لحاوية MP4
+    budget_kbps = max_size_mb * 1024 * 1024 * 8 * 0.95 / duration / 1000
+    audio_kbps = 0
+    if audio:
+        audio_kbps = 128 if budget_kbps >= 600 else max(MIN_AUDIO_KBPS, min(64, int(budget_kbps * 0.2)))
+    video_kbps = int(budget_kbps - audio_kbps)
+    if video_kbps < MIN_VIDEO_KBPS:
+        raise ValueError(f"الفيديو أطول من أن يُضغط تحت {max_size_mb}MB!")
+    height = 720 if video_kbps >= 1500 else 480 if video_kbps >= 700 else 360 if video_kbps >= 300 else 240
+    return video_kbps, audio_kbps, height
+
+# مخطط التحويل: نسخ الدفق عند الإمكان، وإلا ترميز واحد بمعدل بت محسوب من المدة ليبقى تحت الحد
+def plan_transcode(probe, target, max_size_mb=COMPRESS_TARGET_MB):
+    fmt = probe.get('format', {})
+    duration = float(fmt.get('duration') or 0)
+    size = int(fmt.get('size') or 0)
+    video, audio = _stream(probe, 'video'), _stream(probe, 'audio')
+    audio_codec = audio.get('codec_name') if audio else None
+    if target == 'mp3':
+        if audio is None:
+            raise RuntimeError("لا يوجد مسار صوت في الملف!")
+        return ['-vn', '-c:a', 'copy'] if audio_codec == 'mp3' else ['-vn', '-c:a', 'libmp3lame', '-b:a', '192k']
+    if target == 'gif':
+        fps = 15 if duration <= 10 else 12 if duration <= 30 else 10
+        width = min(320, int(video.get('width') or 320)) if video else 320
+        return ['-an', '-vf', f"fps={fps},scale={width}:-1:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse",
+                '-loop', '0']
+    max_bytes = max_size_mb * 1024 * 1024
+    video_ok = video is None or video.get('codec_name') == 'h264'
+    audio_ok = audio is None or audio_codec == 'aac'
+    if size <= max_bytes and video_ok and audio_ok:
+        return ['-c', 'copy', '-movflags', '+faststart']
+    # 5% هامش لحاوية MP4
+    budget_kbps = max_bytes * 8 * 0.95 / duration / 1000 if duration > 0 else None
+    if size <= max_bytes and video_ok:
+        # الفيديو صالح ويتسع: نسخه كما هو وترميز الصوت وحده ضمن ما يتبقى من الميزانية
+        audio_kbps = 128
+        if budget_kbps:
+            video_kbps = size * 8 / duration / 1000 - float(audio.get('bit_rate') or 0) / 1000
+            audio_kbps = min(128, int(budget_kbps - video_kbps))
+        if audio_kbps >= MIN_AUDIO_KBPS:
+            return ['-c:v', 'copy', '-c:a', 'aac', '-b:a', f"{audio_kbps}k", '-movflags', '+faststart']
+    args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p']
+    audio_kbps = 128 if audio else 0
+    if budget_kbps:
+        video_kbps, audio_kbps, height = compress_budget(duration, max_size_mb, audio is not None)
+        args += ['-maxrate', f"{video_kbps}k", '-bufsize', f"{video_kbps * 2}k",
+                 '-vf', f"scale=-2:'min({height},ih)'"]
+    if audio:
+        args += ['-c:a', 'copy'] if audio_ok and size <= max_bytes else ['-c:a', 'aac', '-b:a', f"{audio_kbps}k"]
+    return args + ['-movflags', '+faststart']
+
+async def transcode(input_path, output_path, target, max_size_mb=COMPRESS_TARGET_MB):
+    # ناتج جزئي يُحذف مع إلغاء النطاق المحيط (إن وُجد)
+    token = current_token.get()
+    if token:
+        token.track(path=output_path)
+    probe = await probe_media(input_path)
+    args = plan_transcode(probe, target, max_size_mb)
+    duration = float(probe.get('format', {}).get('duration') or 0)
+    return await run_ffmpeg(['ffmpeg', '-y', '-i', input_path, *args, output_path], duration=duration)
+
 # ضغط الفيديو
-async def compress_video(input_path, output_path, max_size_mb=50):
-    size = os.path.getsize(input_path) / (1024 * 1024)
-    if size <= max_size_mb:
-        shutil.copy(input_path, output_path)
-        return True, ""
-    cmd = f"ffmpeg -i {input_path} -vcodec libx264 -crf 23 -preset medium -acodec aac -b:a 128k {output_path} -y"
-    return await run_ffmpeg(cmd)
+async def compress_video(input_path, output_path, max_size_mb=COMPRESS_TARGET_MB):
+    return await transcode(input_path, output_path, 'mp4', max_size_mb)
 
 # تحويل إلى GIF
-async def convert_to_gif(input_path, output_path, fps=15):
-    cmd = f"ffmpeg -i {input_path} -vf 'fps={fps},scale=320:-1' -loop 0 {output_path} -y"
-    return await run_ffmpeg(cmd)
+async def convert_to_gif(input_path, output_path):
+    return await transcode(input_path, output_path, 'gif')
 
 # تحويل إلى MP3
 async def convert_to_mp3(input_path, output_path):
-    cmd = f"ffmpeg -i {input_path} -vn -acodec mp3 -ab 192k {output_path} -y"
-    return await run_ffmpeg(cmd)
+    return await transcode(input_path, output_path, 'mp3')
+
+# إرسال الملف: يُرفع مرة واحدة على أجزاء (ذاكرة ثابتة) ثم يُعاد الإرسال فقط عند الفشل
+async def upload_media(file):
+    if hasattr(file, 'seek'):
+        size = file.seek(0, io.SEEK_END)
+        file.seek(0)
+    else:
+        size = os.path.getsize(file)
+    progress = current_progress.get()
+    with metrics.timer('stage_seconds', stage='upload'):
+        uploaded = await client.upload_file(file, part_size_kb=UPLOAD_PART_SIZE_KB,
+                                            progress_callback=progress.upload_callback if progress else None)
+    metrics.inc('bytes_total', size, direction='upload')
+    return uploaded
 
-# إرسال الملف
 async def send_file(chat, file, as_doc=False, caption="", retries=3):
+    uploaded = None
     for attempt in range(retries):
         try:
-            await client.send_file(chat, file, force_document=as_doc, caption=caption, parse_mode='markdown')
-            return True
+            if uploaded is None:
+                uploaded = await upload_media(file)
+            return await outbox.send_file(chat, uploaded, force_document=as_doc, caption=caption, parse_mode='markdown',
+                                          supports_streaming=not as_doc)
         except Exception as e:
             if attempt < retries - 1:
-                await asyncio.sleep(5)
+                await asyncio.sleep(e.seconds if isinstance(e, FloodWaitError) else 5)
                 continue
             logging.error(f"Failed to send file: {str(e)}")
-            return False
+            return None
+
+# تسليم ملف كامل، أو على أجزاء إذا تجاوز حد Telegram. تُعاد الرسائل المرسلة أو [] عند الفشل
+async def deliver_file(chat, file_path, as_doc=False, caption=""):
+    if os.path.getsize(file_path) <= MAX_UPLOAD_SIZE:
+        msg = await send_file(chat, file_path, as_doc, caption)
+        return [msg] if msg else []
+    parts = split_file(file_path)
+    messages = []
+    for i, part in enumerate(parts, 1):
+        with part:
+            msg = await send_file(chat, part, True, f"📦 **جزء {i}/{len(parts)}**\n{caption}")
+        if not msg:
+            return []
+        messages.append(msg)
+    return messages
+
+# رفع إلى Drive: جلسة قابلة للاستئناف على أجزاء في مجمع خيوط محدود، ورابط الجلسة يُحفظ لمتابعة الرفع المنقطع
+drive_executor = ThreadPoolExecutor(max_workers=DRIVE_WORKERS, thread_name_prefix='drive')
+drive_local = threading.local()
+
+# httplib2 غير آمن بين الخيوط: لكل خيط خدمة واتصال مصرح به يُعاد استخدامهما
+def drive_client():
+    service = getattr(drive_local, 'service', None)
+    if service is None:
+        http = google_auth_httplib2.AuthorizedHttp(drive_credentials(), http=httplib2.Http(timeout=120))
+        service = drive_local.service = drive_discovery.build('drive', 'v3', http=http, cache_discovery=False)
+    return service
+
+def _drive_request(file_path):
+    media = drive_http.MediaFileUpload(file_path, chunksize=DRIVE_CHUNK_MB * 1024 * 1024, resumable=True)
+    return drive_client().files().create(body={'name': os.path.basename(file_path)}, media_body=media,
+                                         fields='webViewLink')
+
+def _drive_upload(file_path, session_uri, save_session, report, stop):
+    request = _drive_request(file_path)
+    if session_uri:
+        # لا واجهة عامة لاستئناف جلسة محفوظة: حالة الخطأ تجعل المكتبة تسأل الخادم عن الموضع الذي بلغه الرفع
+        # قبل إرسال الجزء التالي. هذه خصائص داخلية، لذا الإصدار مثبت في requirements.txt
+        request.resumable_uri = session_uri
+        request._in_error_state = True
+    response, failures = None, 0
+    while response is None:
+        if stop.is_set():
+            raise RuntimeError("أُلغي رفع Drive!")
+        try:
+            status, response = request.next_chunk(num_retries=DRIVE_RETRIES)
+        except (drive_errors.HttpError, httplib2.HttpLib2Error, OSError) as e:
+            failures += 1
+            if failures > DRIVE_RETRIES:
+                raise
+            if isinstance(e, drive_errors.HttpError) and e.resp.status in (404, 410):
+                # الجلسة انتهت على الخادم: رفع جديد من البداية
+                request, session_uri = _drive_request(file_path), None
+                save_session(None)
+            elif isinstance(e, drive_errors.HttpError) and e.resp.status < 500 and e.resp.status != 429:
+                raise
+            time.sleep(min(2 ** failures, 30))
+            continue
+        failures = 0
+        if request.resumable_uri != session_uri:
+            session_uri = request.resumable_uri
+            save_session(session_uri)
+        if status:
+            report('upload', status.resumable_progress, status.total_size)
+    return response.get('webViewLink')
 
-# رفع إلى Drive/Telegraph
 async def upload_to_drive(file_path):
-    if not drive_service:
+    if not drive_credentials():
         raise RuntimeError("Drive غير مفعل!")
-    media = MediaFileUpload(file_path)
-    file = drive_service.files().create(body={'name': os.path.basename(file_path)}, media_body=media, fields='webViewLink').execute()
-    return file.get('webViewLink')
+    loop = asyncio.get_running_loop()
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_size, stat.st_mtime)
+    async for db in get_db():
+        async with db.execute("SELECT session_uri FROM drive_uploads WHERE file_path=? AND size=? AND mtime=?",
+                              key) as cursor:
+            row = await cursor.fetchone()
+    session_uri = row[0] if row else None
+
+    def save_session(uri):
+        loop.call_soon_threadsafe(db_writes.add, "INSERT OR REPLACE INTO drive_uploads (file_path, size, mtime, "
+                                  "session_uri, updated) VALUES (?, ?, ?, ?, ?)", (*key, uri, time.time()))
+    progress = current_progress.get()
+    report = progress.from_thread(loop) if progress else lambda *args: None
+    stop = threading.Event()
+    try:
+        with metrics.timer('stage_seconds', stage='drive'):
+            link = await loop.run_in_executor(drive_executor, _drive_upload, file_path, session_uri, save_session,
+                                              report, stop)
+    except asyncio.CancelledError:
+        # الخيط يتوقف عند نهاية الجزء الحالي، والجلسة المحفوظة تسمح بالمتابعة لاحقاً
+        stop.set()
+        raise
+    db_writes.add("DELETE FROM drive_uploads WHERE file_path=?", (file_path,))
+    metrics.inc('bytes_total', stat.st_size, direction='upload')
+    return link
+
+# حساب Telegraph يُنشأ عند أول رفع فقط، ورمزه يُحفظ في قاعدة البيانات فلا يتكرر الإنشاء بعد إعادة التشغيل
+telegraph = None
+telegraph_lock = asyncio.Lock()
+
+async def get_telegraph():
+    global telegraph
+    async with telegraph_lock:
+        if telegraph is None:
+            loop = asyncio.get_running_loop()
+            async for db in get_db():
+                async with db.execute("SELECT value FROM settings WHERE key='telegraph_token'") as cursor:
+                    row = await cursor.fetchone()
+            account = telegraph_api.Telegraph(row[0] if row else None)
+            if not row:
+                await loop.run_in_executor(None, functools.partial(account.create_account, short_name='TechnoSyriaBot'))
+                if account.get_access_token():
+                    db_writes.add("INSERT OR REPLACE INTO settings (key, value) VALUES ('telegraph_token', ?)",
+                                  (account.get_access_token(),))
+            telegraph = account
+    return telegraph
 
 async def upload_to_telegraph(file_path):
-    with open(file_path, 'rb') as f:
-        response = telegraph.upload_file(f)
-        if not response:
-            raise RuntimeError("فشل رفع الملف إلى Telegraph!")
-        return f"https://telegra.ph{response[0]['src']}"
+    account = await get_telegraph()
+
+    def upload():
+        with open(file_path, 'rb') as f:
+            return account.upload_file(f)
+    response = await asyncio.get_running_loop().run_in_executor(None, upload)
+    if not response:
+        raise RuntimeError("فشل رفع الملف إلى Telegraph!")
+    return f"https://telegra.ph{response[0]['src']}"
 
 # إعادة المحاولة
 async def retry_on_failure(func, retries=3, delay=5):
@@ -264,173 +1690,717 @@ async def retry_on_failure(func, retries=3, delay=5):
 # تحميل الوسائط
 async def download_media(url, event, platform, quality='best', audio_only=False, as_doc=False, to_gif=False, share_link=False, to_drive=False, is_playlist=False):
     if event.sender_id in banned_users:
-        await event.reply("❌ **أنت محظور!**\n@techno_syria_bot")
+        await outbox.reply(event, "❌ **أنت محظور!**\n@techno_syria_bot")
         return
     if not validate_url(url):
-        await event.reply("❌ **رابط غير صالح!**\n@techno_syria_bot")
+        await outbox.reply(event, "❌ **رابط غير صالح!**\n@techno_syria_bot")
+        return
+    # المنصة المعطلة تُرفض قبل التسجيل (في عملية واحدة يرى البوت نفس القاطع الذي يراه العامل)
+    try:
+        platform_adapter(platform).breaker.check()
+    except RuntimeError as e:
+        await outbox.reply(event, f"⚠️ **{str(e)}**\n@techno_syria_bot")
         return
 
     # التحقق المسبق
     if not check_cookies() and platform.lower() == 'youtube':
-        await event.reply("⚠️ **تحذير:** ملف الكوكيز مفقود، قد يفشل تحميل يوتيوب!\n@techno_syria_bot")
+        await outbox.reply(event, "⚠️ **تحذير:** ملف الكوكيز مفقود، قد يفشل تحميل يوتيوب!\n@techno_syria_bot")
     if to_gif or not audio_only:
         if not check_ffmpeg():
-            await event.reply("❌ **خطأ:** FFmpeg غير مثبت!\n@techno_syria_bot")
+            await outbox.reply(event, "❌ **خطأ:** FFmpeg غير مثبت!\n@techno_syria_bot")
             return
 
-    async with semaphore:
-        task = asyncio.create_task(process_download(url, event, platform, quality, audio_only, as_doc, to_gif, share_link, to_drive, is_playlist))
-        active_downloads[event.sender_id] = task
-        try:
-            await task
-        except asyncio.CancelledError:
-            await event.reply("🛑 **تم الإلغاء!**\n@techno_syria_bot")
-        except Exception as e:
-            await event.reply(f"❌ **خطأ:** {str(e)}\n@techno_syria_bot")
-        finally:
-            if event.sender_id in active_downloads:
-                del active_downloads[event.sender_id]
+    status_msg = await outbox.reply(event, f"⚡ **جاري تحميل {platform}...** ⏳", parse_mode='markdown')
+    await enqueue_job('media', event, status_msg, url=url, platform=platform, quality=quality, audio_only=audio_only,
+                      as_doc=as_doc, to_gif=to_gif, share_link=share_link, to_drive=to_drive, is_playlist=is_playlist)
 
-async def process_download(url, event, platform, quality, audio_only, as_doc, to_gif, share_link, to_drive, is_playlist):
-    status_msg = await event.reply(f"⚡ **جاري تحميل {platform}...** ⏳", parse_mode='markdown')
+# تنزيل الملفات ومعالجتها؛ المسار فريد لكل مفتاح حتى لا تتصادم الطلبات المختلفة
+def downloaded_files(ydl, info):
+    entries = [e for e in info.get('entries') or [] if e] if info.get('_type') == 'playlist' else [info]
     files = []
-    async for db in get_db():
-        async with db.execute("SELECT file_path FROM cache WHERE url=?", (url,)) as cursor:
-            cached = await cursor.fetchone()
-        if cached and os.path.exists(cached[0]) and os.path.getsize(cached[0]) > 0 and not is_playlist:
-            files = [cached[0]]
-            await status_msg.edit("⚡ **تم العثور على الملف في المخبأ!** ⏳")
-        else:
-            ydl_opts = {
-                'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]' if quality == 'best' else quality,
-                'outtmpl': 'downloads/%(title)s.%(ext)s',
-                'quiet': True,
-                'merge_output_format': 'mp4',
-                'max_filesize': 2 * 1024 * 1024 * 1024,
-                'noplaylist': not is_playlist,
-                'cookiefile': COOKIES_PATH,
-                'http_headers': {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/91.0.4472.124'},
-            }
-            if audio_only:
-                ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
-                del ydl_opts['merge_output_format']
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    loop = asyncio.get_running_loop()
-                    info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=True))
-                    if not info or not info.get('title'):
-                        raise ValueError("فشل استخراج المعلومات!")
-                    if is_playlist:
-                        files = [f"downloads/{slugify(entry['title'])}.{'mp3' if audio_only else 'mp4'}" for entry in info['entries'] if entry]
-                    else:
-                        file_path = f"downloads/{slugify(info['title'])}.{'mp3' if audio_only else 'mp4'}"
-                        files = [file_path]
-                processed_files = []
-                for file in files:
-                    if not os.path.exists(file) or os.path.getsize(file) == 0:
-                        raise FileNotFoundError(f"الملف {file} غير موجود!")
-                    if not audio_only and not to_gif:
-                        output = f"{os.path.splitext(file)[0]}_compressed.mp4"
-                        success, _ = await compress_video(file, output)
-                        if not success:
-                            raise RuntimeError("فشل الضغط!")
-                        os.remove(file)
-                        processed_files.append(output)
-                    elif to_gif:
-                        output = f"{os.path.splitext(file)[0]}.gif"
-                        success, _ = await convert_to_gif(file, output)
-                        if not success:
-                            raise RuntimeError("فشل تحويل GIF!")
-                        os.remove(file)
-                        processed_files.append(output)
-                    else:
-                        processed_files.append(file)
-                files = processed_files
-                if not is_playlist and files:
-                    await db.execute("INSERT OR REPLACE INTO cache (url, file_path, timestamp) VALUES (?, ?, ?)", 
-                                    (url, files[0], time.time()))
-                    await db.commit()
-            except Exception as e:
-                stats['errors'] += 1
-                await status_msg.edit(f"❌ **فشل التحميل:** {str(e)}\n@techno_syria_bot", 
-                                     buttons=[Button.inline("🔄 حاول مجدداً", f"retry_{platform}_{url}")])
-                return
-    try:
-        await status_msg.edit("⚡ **جاري الإرسال...** ⏳")
+    for entry in entries:
+        downloads = entry.get('requested_downloads') or [{}]
+        files.append(downloads[0].get('filepath') or ydl.prepare_filename(entry))
+    return files
+
+# الفحص المسبق: معلومات الرابط بدون تحميل، مخزنة لكل رابط
+async def probe_url(url):
+    info = probe_cache.get(url)
+    metrics.inc('cache_requests_total', cache='probe', result='miss' if info is None else 'hit')
+    if info is None:
+        loop = asyncio.get_running_loop()
+        with yt_dlp.YoutubeDL({**YDL_BASE_OPTS, 'noplaylist': True}) as ydl, \
+                metrics.timer('stage_seconds', stage='extract'):
+            info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
+        if not info or not info.get('title'):
+            raise ValueError("فشل استخراج المعلومات!")
+        probe_cache[url] = info
+    return info
+
+def estimate_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+# اختيار أفضل صيغة تتسع في حد التسليم قبل تحميل أي بايت
+def select_format(info, quality, audio_only, to_gif):
+    formats = info.get('formats') or []
+    duration = info.get('duration')
+    if not formats or (quality != 'best' and 'height<=' not in quality and not audio_only):
+        return None
+    height_match = re.search(r'height<=(\d+)', quality)
+    max_height = int(height_match.group(1)) if height_match else 480 if to_gif else 720
+    has_video = lambda f: f.get('vcodec') not in (None, 'none')
+    has_audio = lambda f: f.get('acodec') not in (None, 'none')
+    candidates = []
+    if audio_only:
+        for f in formats:
+            if has_audio(f) and not has_video(f):
+                candidates.append((f['format_id'], estimate_size(f, duration), (f.get('abr') or 0,)))
+    else:
+        audios = [f for f in formats if has_audio(f) and not has_video(f)]
+        # أصغر صوت AAC مقبول يكفي للدمج؛ الضغط يعيد ترميز الصوت على أي حال
+        audio = min(audios, key=lambda f: (not (f.get('acodec') or '').startswith('mp4a'), estimate_size(f, duration) or 0), default=None)
+        for f in formats:
+            if not has_video(f) or (f.get('height') or 0) > max_height:
+                continue
+            rank = (f.get('height') or 0, (f.get('vcodec') or '').startswith('avc1'), f.get('tbr') or 0)
+            size = estimate_size(f, duration)
+            if has_audio(f):
+                candidates.append((f['format_id'], size, rank))
+            elif to_gif:
+                candidates.append((f['format_id'], size, rank))
+            elif audio:
+                audio_size = estimate_size(audio, duration)
+                total = size + audio_size if size and audio_size else None
+                candidates.append((f"{f['format_id']}+{audio['format_id']}", total, rank))
+    known = [c for c in candidates if c[1]]
+    if not known:
+        return None
+    target = MAX_UPLOAD_SIZE if audio_only else COMPRESS_TARGET_MB * 1024 * 1024
+    fitting = [c for c in known if c[1] <= target]
+    if fitting:
+        return max(fitting, key=lambda c: c[2])[0]
+    deliverable = [c for c in known if c[1] <= MAX_UPLOAD_SIZE]
+    if not deliverable:
+        smallest = min(c[1] for c in known) / (1024 * 1024)
+        raise ValueError(f"الملف أكبر من الحد المسموح ({smallest:.0f}MB)!")
+    if to_gif or not duration:
+        return min(deliverable, key=lambda c: c[1])[0]
+    # لا شيء يتسع بلا ضغط: الضغط سيخرج بارتفاع تحدده المدة، فأصغر صيغة لا تقل عنه تكفي وما فوقها تحميل مهدور
+    _, _, height = compress_budget(duration)
+    enough = [c for c in deliverable if c[2][0] >= height]
+    return min(enough, key=lambda c: c[1])[0] if enough else max(deliverable, key=lambda c: c[2])[0]
+
+# key_url: الرابط الموحد لمفتاح المخبأ فقط، والتحميل دائماً من الرابط الأصلي
+async def fetch_media(url, quality, audio_only, to_gif, tag, user_id, on_wait=None, key_url=None):
+    cache_key = f"{key_url or url}|{media_variant(quality, audio_only, to_gif)}"
+    cached = cache_store.get(cache_key)
+    metrics.inc('cache_requests_total', cache='disk', result='hit' if cached else 'miss')
+    if cached:
+        # الرابط الذي ينتج عدة ملفات يُخزن أجزاءً متتالية: cache_key ثم cache_key#1 ...
+        files = [cached]
+        while part := cache_store.get(f"{cache_key}#{len(files)}"):
+            files.append(part)
+        return files, True
+    async with cancel_scope() as token:
+        # الوسم يلتقط ملفات yt-dlp الوسيطة (أجزاء الصيغ و .part و .ytdl) التي لا تُعرف أسماؤها مسبقاً،
+        # ومخرجات الترميز تُسجل بمساراتها من transcode
+        token.track(tag=tag)
+        ydl_opts = {
+            **YDL_BASE_OPTS,
+            'format': 'bestvideo[height<=720]+bestaudio/best[height<=720]' if quality == 'best' else quality,
+            'outtmpl': f'downloads/%(title).80B [%(id)s] {tag}.%(ext)s',
+            'merge_output_format': 'mp4',
+            'max_filesize': 2 * 1024 * 1024 * 1024,
+            'noplaylist': True,
+        }
+        if audio_only:
+            ydl_opts['format'] = 'bestaudio/best' if quality == 'best' else quality
+            del ydl_opts['merge_output_format']
+        loop = asyncio.get_running_loop()
+        ydl_opts['progress_hooks'] = [token.hook]
+        ydl_opts['postprocessor_hooks'] = [token.hook]
+        progress = current_progress.get()
+        if progress:
+            report = progress.from_thread(loop)
+
+            def hook(d):
+                if d.get('status') == 'downloading':
+                    report('fetch', d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate'))
+            ydl_opts['progress_hooks'].append(hook)
+        async with fetch_slot(user_id, on_wait):
+            info = await probe_url(url)
+            ydl_opts['format'] = select_format(info, quality, audio_only, to_gif) or ydl_opts['format']
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl, metrics.timer('stage_seconds', stage='download'):
+                info = await token.run_in_thread(
+                    lambda: ydl.process_ie_result(yt_dlp.YoutubeDL.sanitize_info(info, True), download=True))
+                files = downloaded_files(ydl, info)
+        processed_files = []
         for file in files:
-            size = os.path.getsize(file) / (1024 * 1024)
-            caption = f"{'🎵' if audio_only else '🎬' if to_gif else '🎥'} **{os.path.basename(file)}**\n@techno_syria_bot"
-            if share_link:
-                link = await upload_to_telegraph(file)
-                await event.reply(f"🔗 **رابط Telegraph:** {link}\n@techno_syria_bot")
-            elif to_drive:
-                link = await upload_to_drive(file)
-                await event.reply(f"📂 **رابط Drive:** {link}\n@techno_syria_bot")
-            elif size > 50:
-                parts = await split_file(file)
-                for i, part in enumerate(parts, 1):
-                    await send_file(event.chat_id, part, as_doc, f"📦 **جزء {i}/{len(parts)}**\n{caption}")
-                    os.remove(part)
+            if not os.path.exists(file) or os.path.getsize(file) == 0:
+                raise FileNotFoundError(f"الملف {file} غير موجود!")
+            metrics.inc('bytes_total', os.path.getsize(file), direction='download')
+            if not audio_only and not to_gif:
+                output = f"{os.path.splitext(file)[0]}_compressed.mp4"
+                async with scheduler.transcode.slot(user_id, on_wait):
+                    success, _ = await compress_video(file, output)
+                if not success:
+                    raise RuntimeError("فشل الضغط!")
+                os.remove(file)
+                processed_files.append(output)
+            elif to_gif:
+                output = f"{os.path.splitext(file)[0]}.gif"
+                async with scheduler.transcode.slot(user_id, on_wait):
+                    success, _ = await convert_to_gif(file, output)
+                if not success:
+                    raise RuntimeError("فشل تحويل GIF!")
+                os.remove(file)
+                processed_files.append(output)
             else:
-                await send_file(event.chat_id, file, as_doc, caption)
-            stats['downloads'] += 1
-            if not cached or is_playlist:
+                output = f"{os.path.splitext(file)[0]}{'_audio' if file.endswith('.mp3') else ''}.mp3"
+                async with scheduler.transcode.slot(user_id, on_wait):
+                    success, _ = await convert_to_mp3(file, output)
+                if not success:
+                    raise RuntimeError("فشل تحويل MP3!")
                 os.remove(file)
-        await status_msg.delete()
+                processed_files.append(output)
+        for i, file in enumerate(processed_files):
+            cache_store.put(cache_key if i == 0 else f"{cache_key}#{i}", file)
+        return processed_files, False
+
+def release_fetched(result):
+    files, _ = result
+    for file in files:
+        cache_store.unpin(file)
+
+# وضع البث: yt-dlp ← ffmpeg ← رفع Telegram عبر الأنابيب بدون ملفات وسيطة
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+def probe_from_info(info, format_id):
+    fmt = next((f for f in info.get('formats') or [] if f.get('format_id') == format_id), None)
+    if fmt is None:
+        return None
+    codec = lambda c: 'h264' if c.startswith(('avc1', 'avc3', 'h264')) else 'aac' if c.startswith('mp4a') else c.split('.')[0]
+    streams = []
+    if fmt.get('vcodec') not in (None, 'none'):
+        streams.append({'codec_type': 'video', 'codec_name': codec(fmt['vcodec']), 'width': fmt.get('width')})
+    if fmt.get('acodec') not in (None, 'none'):
+        streams.append({'codec_type': 'audio', 'codec_name': codec(fmt['acodec'])})
+    duration = info.get('duration') or 0
+    return {'format': {'duration': duration, 'size': estimate_size(fmt, duration) or 0}, 'streams': streams}
+
+# رفع دفق مجهول الحجم: أجزاء كبيرة بعدد كلي -1 حتى الجزء الأخير. أول BIG_FILE_THRESHOLD يبقى في الذاكرة
+# لمعرفة هل الملف صغير (رفع عادي) أم كبير، وبعدها لا يتجاوز المخزن جزأين. started يُضبط قبل أول جزء كبير يُرسل
+async def upload_stream(reader, name, started=None):
+    part_size = UPLOAD_PART_SIZE_KB * 1024
+    pending = bytearray()
+    eof = False
+    while len(pending) <= BIG_FILE_THRESHOLD and not eof:
+        chunk = await reader.read(part_size)
+        eof = not chunk
+        pending += chunk
+    if eof:
+        if not pending:
+            raise RuntimeError("البث لم ينتج أي بيانات!")
+        metrics.inc('bytes_total', len(pending), direction='upload')
+        return await client.upload_file(bytes(pending), file_name=name)
+    file_id = generate_random_long()
+    progress = current_progress.get()
+    part = 0
+    if started:
+        started.set()
+    while True:
+        while len(pending) < 2 * part_size and not eof:
+            chunk = await reader.read(part_size)
+            eof = not chunk
+            pending += chunk
+        if eof:
+            parts = part + (len(pending) + part_size - 1) // part_size
+            for offset in range(0, len(pending), part_size):
+                await client(SaveBigFilePartRequest(file_id, part, parts, bytes(pending[offset:offset + part_size])))
+                part += 1
+            metrics.inc('bytes_total', len(pending), direction='upload')
+            return InputFileBig(file_id, parts, name)
+        if (part + 1) * part_size > MAX_UPLOAD_SIZE:
+            raise ValueError("الملف أكبر من 2GB!")
+        await client(SaveBigFilePartRequest(file_id, part, -1, bytes(pending[:part_size])))
+        del pending[:part_size]
+        part += 1
+        metrics.inc('bytes_total', part_size, direction='upload')
+        if progress:
+            progress.update('upload', part * part_size)
+
+async def _drain(stream):
+    return await stream.read()
+
+# يُعيد الرسائل المرسلة، أو None إذا كانت الصيغة لا تصلح للبث أو فشل البث قبل رفع أول جزء كبير (يُستخدم مسار الملفات)
+async def stream_media(url, quality, audio_only, as_doc, chat, user_id, on_wait=None):
+    async with fetch_slot(user_id, on_wait):
+        info = await probe_url(url)
+    format_id = select_format(info, quality, audio_only, False)
+    probe = probe_from_info(info, format_id) if format_id and '+' not in format_id else None
+    if probe is None:
+        return None
+    target = 'mp3' if audio_only else 'mp4'
+    args = [a if a != '+faststart' else 'frag_keyframe+empty_moov+default_base_moof'
+            for a in plan_transcode(probe, target)]
+    name = f"{info.get('title', 'media')[:80]}.{target}"
+    caption = f"{'🎵' if audio_only else '🎥'} **{name}**\n@techno_syria_bot"
+    downloader_cmd = [sys.executable, '-m', 'yt_dlp', '-q', '--no-part', '-f', format_id, '-o', '-',
+                      '--user-agent', YDL_BASE_OPTS['http_headers']['User-Agent'], url]
+    if check_cookies():
+        downloader_cmd[-1:-1] = ['--cookies', COOKIES_PATH]
+    encoder_cmd = ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', *args, '-f', target, 'pipe:1']
+    async with fetch_slot(user_id, on_wait), scheduler.transcode.slot(user_id, on_wait), \
+            scheduler.upload.slot(user_id, on_wait):
+        read_fd, write_fd = os.pipe()
+        try:
+            downloader = await asyncio.create_subprocess_exec(*downloader_cmd, stdout=write_fd,
+                                                              stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            encoder = await asyncio.create_subprocess_exec(*encoder_cmd, stdin=read_fd, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        errors = [asyncio.create_task(_drain(downloader.stderr)), asyncio.create_task(_drain(encoder.stderr))]
+        started = asyncio.Event()
+        try:
+            try:
+                with metrics.timer('stage_seconds', stage='stream'):
+                    uploaded = await upload_stream(encoder.stdout, name, started)
+                await asyncio.wait_for(asyncio.gather(downloader.wait(), encoder.wait()), timeout=60)
+            except BaseException:
+                for process in (downloader, encoder):
+                    kill_group(process)
+                raise
+            downloader_err, encoder_err = [(await task).decode(errors='ignore').strip() for task in errors]
+            if downloader.returncode != 0:
+                raise RuntimeError(f"yt-dlp فشل: {downloader_err}")
+            if encoder.returncode != 0:
+                raise RuntimeError(f"FFmpeg فشل: {encoder_err}")
+        except (RuntimeError, OSError) as e:
+            # ما لا يقرؤه ffmpeg من الأنبوب (فهرس MP4 في آخر الملف مثلاً) يفشل مبكراً: مسار الملفات بدلاً من إفشال المهمة
+            if started.is_set():
+                raise
+            logging.warning(f"Stream of {url} failed before upload, falling back to files: {str(e)}")
+            metrics.inc('stream_fallbacks_total')
+            return None
+        duration = int(info.get('duration') or 0)
+        if audio_only:
+            attributes = [DocumentAttributeAudio(duration, title=info.get('title'), performer=info.get('uploader'))]
+        else:
+            attributes = [DocumentAttributeVideo(duration, info.get('width') or 0, info.get('height') or 0,
+                                                 supports_streaming=True)]
+        msg = await outbox.send_file(chat, uploaded, force_document=as_doc, caption=caption, parse_mode='markdown',
+                                     attributes=attributes, supports_streaming=not as_doc)
+    return [msg]
+
+async def set_status(status_msg, text, **kwargs):
+    if status_msg:
+        with contextlib.suppress(Exception):
+            await outbox.edit(status_msg, text, **kwargs)
+
+# أسماء الملفات تختلف بين العمال حتى لا تتصادم تنزيلات نفس الرابط في عمليتين
+def media_tag(key):
+    return hashlib.sha1(repr((key, WORKER_NAME)).encode()).hexdigest()[:10]
+
+# تسليم رابط واحد: مخبأ المراجع، ثم البث، ثم التنزيل المشترك. يرفع استثناءً عند الفشل
+async def deliver_media(url, event, platform, status_msg, on_wait, quality, audio_only, as_doc, to_gif, share_link, to_drive):
+    key_url = platform_adapter(platform).normalize(url)
+    variant = media_variant(quality, audio_only, to_gif, as_doc)
+    reuse_media = not (share_link or to_drive)
+    if reuse_media:
+        async for db in get_db():
+            if await send_cached_media(db, event.chat_id, key_url, variant):
+                metrics.inc('deliveries_total', platform=platform, source='reference')
+                return
+    key = (key_url, quality, audio_only, to_gif)
+    tag = media_tag(key)
+    if STREAM_MODE and reuse_media and not to_gif:
+        stream_key = ('stream', as_doc) + key
+        leader = stream_key not in inflight
+        # القائد يرسل إلى محادثته ويحفظ المرجع، والبقية يعيدون الإرسال بالمرجع
+        async def stream(on_wait):
+            messages = await stream_media(url, quality, audio_only, as_doc, event.chat_id, event.sender_id, on_wait)
+            if messages:
+                async for db in get_db():
+                    await save_cached_media(db, key_url, variant, messages)
+            return messages
+        async with inflight.join(stream_key, stream, on_wait=on_wait) as flight:
+            messages = flight.task.result()
+        if messages is not None:
+            if not leader:
+                async for db in get_db():
+                    if not await send_cached_media(db, event.chat_id, key_url, variant):
+                        raise RuntimeError("تعذر إعادة إرسال الملف!")
+            metrics.inc('deliveries_total', platform=platform, source='stream')
+            return
+    if key in inflight:
+        await set_status(status_msg, "⚡ **نفس الرابط قيد التحميل لمستخدم آخر، بانتظار النتيجة...** ⏳")
+    fetch = lambda on_wait: fetch_media(url, quality, audio_only, to_gif, tag, event.sender_id, on_wait, key_url)
+    async with inflight.join(key, fetch, release_fetched, on_wait=on_wait) as flight:
+        files, cached = flight.task.result()
+        if cached:
+            await set_status(status_msg, "⚡ **تم العثور على الملف في المخبأ!** ⏳")
+        await set_status(status_msg, "⚡ **جاري الإرسال...** ⏳")
+        caption = lambda file: f"{'🎵' if audio_only else '🎬' if to_gif else '🎥'} **{os.path.basename(file)}**\n@techno_syria_bot"
+        if share_link or to_drive:
+            for file in files:
+                async with scheduler.upload.slot(event.sender_id, on_wait):
+                    link = await (upload_to_telegraph(file) if share_link else upload_to_drive(file))
+                label = "🔗 **رابط Telegraph:**" if share_link else "📂 **رابط Drive:**"
+                await outbox.reply(event, f"{label} {link}\n@techno_syria_bot")
+        else:
+            # أول منتظر يرفع كل الملفات ويحفظها أجزاءً لمدخل واحد، والبقية يعيدون إرسالها بالمرجع.
+            # المخبأ يُفحص مرة واحدة قبل الحلقة: الرابط الذي ينتج عدة ملفات لا يجد مرجع الملف الأول لبقية الملفات
+            async with flight.lock:
+                async for db in get_db():
+                    if not await send_cached_media(db, event.chat_id, key_url, variant):
+                        messages = []
+                        for file in files:
+                            async with scheduler.upload.slot(event.sender_id, on_wait):
+                                sent = await deliver_file(event.chat_id, file, as_doc, caption(file))
+                            if not sent:
+                                raise RuntimeError("فشل إرسال الملف!")
+                            messages += sent
+                        await save_cached_media(db, key_url, variant, messages)
+        metrics.inc('deliveries_total', len(files), platform=platform, source='file')
+
+async def process_download(event, status_msg, url, platform, quality, audio_only, as_doc, to_gif, share_link, to_drive,
+                           is_playlist):
+    on_wait = queue_notifier(status_msg)
+    if not is_playlist:
+        current_progress.set(JobProgress(status_msg))
+    try:
+        with metrics.job(platform):
+            async with platform_adapter(platform).run():
+                if is_playlist:
+                    await process_playlist(url, event, platform, status_msg, on_wait, quality, audio_only, as_doc,
+                                           to_gif, share_link, to_drive)
+                else:
+                    await deliver_media(url, event, platform, status_msg, on_wait, quality, audio_only, as_doc, to_gif,
+                                        share_link, to_drive)
+                    await outbox.delete(status_msg)
     except Exception as e:
-        stats['errors'] += 1
-        await status_msg.edit(f"❌ **فشل الإرسال:** {str(e)}\n@techno_syria_bot")
+        await outbox.edit(status_msg, f"❌ **فشل التحميل:** {str(e)}\n@techno_syria_bot",
+                              buttons=[Button.inline("🔄 حاول مجدداً", f"retry_{platform}_{url}")])
+        raise
+
+# قوائم التشغيل: تعداد كسول للعناصر، وكل عنصر يُحمَّل ويُرسَل ويُحذف فور جاهزيته
+def resolve_playlist(ydl, url, max_hops=3):
+    info = ydl.extract_info(url, download=False, process=False)
+    for _ in range(max_hops):
+        if not info or info.get('_type') not in ('url', 'url_transparent'):
+            break
+        info = ydl.extract_info(info['url'], download=False, process=False)
+    return info
+
+async def process_playlist(url, event, platform, status_msg, on_wait, quality, audio_only, as_doc, to_gif, share_link, to_drive):
+    loop = asyncio.get_running_loop()
+    async with fetch_slot(event.sender_id, on_wait):
+        with yt_dlp.YoutubeDL({**YDL_BASE_OPTS, 'extract_flat': 'in_playlist'}) as ydl:
+            info = await loop.run_in_executor(None, resolve_playlist, ydl, url)
+    if not info:
+        raise ValueError("فشل استخراج المعلومات!")
+    entries = iter(info['entries'] if info.get('entries') is not None else [info])
+    limiter = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+    progress = {'done': 0, 'failed': 0}
+    tasks = set()
+
+    async def run_entry(entry_url):
+        try:
+            await deliver_media(entry_url, event, platform, None, on_wait, quality, audio_only, as_doc, to_gif,
+                                share_link, to_drive)
+            progress['done'] += 1
+        except Exception as e:
+            progress['failed'] += 1
+            metrics.inc('playlist_entry_errors_total', platform=platform)
+            logging.warning(f"Playlist entry failed ({entry_url}): {str(e)}")
+        finally:
+            limiter.release()
+        await set_status(status_msg, f"📃 **قائمة التشغيل:** ✅ {progress['done']} | ❌ {progress['failed']} ⏳")
+
+    try:
+        while True:
+            await limiter.acquire()
+            entry = await loop.run_in_executor(None, next, entries, None)
+            if entry is None:
+                limiter.release()
+                break
+            entry_url = entry.get('webpage_url') or entry.get('url')
+            if not entry_url or not validate_url(entry_url):
+                limiter.release()
+                continue
+            tasks.add(asyncio.create_task(run_entry(entry_url)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if not progress['done']:
+        raise RuntimeError("فشل تحميل جميع عناصر القائمة!")
+    if progress['failed']:
+        await outbox.edit(status_msg, f"📃 **اكتملت القائمة:** ✅ {progress['done']} | ❌ {progress['failed']}\n@techno_syria_bot")
+    else:
+        await outbox.delete(status_msg)
 
 # تحميل Reels فوراً
 async def download_instagram_reels(url, event):
     if not validate_url(url):
-        await event.reply("❌ **رابط غير صالح!**\n@techno_syria_bot")
+        await outbox.reply(event, "❌ **رابط غير صالح!**\n@techno_syria_bot")
         return
-    async with semaphore:
-        task = asyncio.create_task(process_instagram_reels(url, event))
-        active_downloads[event.sender_id] = task
-        try:
-            await task
-        except Exception:
-            if event.sender_id in active_downloads:
-                del active_downloads[event.sender_id]
-
-async def process_instagram_reels(url, event):
-    status_msg = await event.reply("⚡ **جاري تحميل Reel...** ⏳", parse_mode='markdown')
-    match = re.search(INSTA_REELS_PATTERN, url)
-    if not match:
-        stats['errors'] += 1
-        await status_msg.edit("❌ **رابط Reel غير صالح!**\n@techno_syria_bot")
+    if not re.search(INSTA_REELS_PATTERN, url):
+        metrics.inc('jobs_total', platform='Reels', status='error')
+        await outbox.reply(event, "❌ **رابط Reel غير صالح!**\n@techno_syria_bot")
         return
-    shortcode = match.group(1)
-    file_path = None
     try:
-        L = instaloader.Instaloader(dirname_pattern="downloads/{shortcode}", download_comments=False, save_metadata=False)
-        post = await asyncio.get_running_loop().run_in_executor(None, lambda: instaloader.Post.from_shortcode(L.context, shortcode))
+        platform_adapter('Instagram').breaker.check()
+    except RuntimeError as e:
+        await outbox.reply(event, f"⚠️ **{str(e)}**\n@techno_syria_bot")
+        return
+    status_msg = await outbox.reply(event, "⚡ **جاري تحميل Reel...** ⏳", parse_mode='markdown')
+    await enqueue_job('reel', event, status_msg, url=url)
+
+# Reels: سياقات Instaloader مشتركة بين الطلبات (جلسة واتصالات معاد استخدامها) بدلاً من نسخة لكل طلب
+class InstaloaderPool:
+    def __init__(self, size):
+        self.size = size
+        self.created = 0
+        self._idle = asyncio.Queue()
+
+    @contextlib.asynccontextmanager
+    async def context(self):
+        if self._idle.empty() and self.created < self.size:
+            self.created += 1
+            loader = instaloader.Instaloader(download_pictures=False, download_video_thumbnails=False,
+                                             download_geotags=False, download_comments=False, save_metadata=False,
+                                             quiet=True, max_connection_attempts=2)
+        else:
+            loader = await self._idle.get()
+        try:
+            yield loader.context
+        finally:
+            self._idle.put_nowait(loader)
+
+instaloader_pool = InstaloaderPool(FETCH_WORKERS)
+reel_cache = TTLCache(maxsize=1024, ttl=REEL_TTL)
+
+async def resolve_reel(shortcode):
+    reel = reel_cache.get(shortcode)
+    metrics.inc('cache_requests_total', cache='reel', result='miss' if reel is None else 'hit')
+    if reel is None:
+        async def resolve():
+            async with instaloader_pool.context() as context:
+                with metrics.timer('stage_seconds', stage='extract'):
+                    return await asyncio.get_running_loop().run_in_executor(
+                        None, instaloader.Post.from_shortcode, context, shortcode)
+        async with inflight.join(('reel', shortcode), lambda _: resolve()) as flight:
+            post = flight.task.result()
         if not post.is_video or not post.video_url:
             raise ValueError("المحتوى ليس Reel أو خاص!")
-        await asyncio.get_running_loop().run_in_executor(None, lambda: L.download_post(post, "downloads"))
-        file_path = f"downloads/{shortcode}/{shortcode}.mp4"
+        reel = reel_cache[shortcode] = {'video_url': post.video_url, 'caption': post.caption}
+    return reel
+
+# تحميل مباشر بطلبات نطاق متوازية عبر مجمع اتصالات مشترك؛ كل جزء يُكتب في موضعه من الملف
+RANGE_MIN_PART = 1024 * 1024
+range_executor = ThreadPoolExecutor(max_workers=REEL_RANGE_PARTS * FETCH_WORKERS, thread_name_prefix='range')
+
+@functools.lru_cache(maxsize=1)
+def http_pool():
+    session = requests.Session()
+    session.headers['User-Agent'] = YDL_BASE_OPTS['http_headers']['User-Agent']
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=REEL_RANGE_PARTS * FETCH_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def _probe_range(url):
+    with http_pool().get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        match = re.match(r'bytes 0-0/(\d+)', response.headers.get('Content-Range', ''))
+        return int(match.group(1)) if response.status_code == 206 and match else None
+
+def _fetch_range(url, path, start, end, advance, stop, attempts=3):
+    offset = start
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for attempt in range(attempts):
+            if end is None:
+                offset = start
+            headers = {'Range': f'bytes={offset}-{end}'} if end is not None else {}
+            try:
+                with http_pool().get(url, headers=headers, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if end is not None and response.status_code != 206:
+                        raise RuntimeError("الخادم تجاهل طلب النطاق!")
+                    for chunk in response.iter_content(256 * 1024):
+                        if stop.is_set():
+                            return
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        advance(len(chunk))
+                return
+            except requests.HTTPError:
+                raise
+            except (requests.RequestException, OSError):
+                # الأجزاء المنقطعة تُستأنف من آخر بايت مكتوب
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(2 ** attempt)
+    finally:
+        os.close(fd)
+
+async def download_ranges(url, path, parts=REEL_RANGE_PARTS):
+    loop = asyncio.get_running_loop()
+    size = await loop.run_in_executor(range_executor, _probe_range, url)
+    progress = current_progress.get()
+    report = progress.from_thread(loop) if progress else None
+    done, lock, stop = [0], threading.Lock(), threading.Event()
+
+    def advance(n):
+        with lock:
+            done[0] += n
+            value = done[0]
+        if report:
+            report('fetch', value, size)
+    if size:
+        step = -(-size // max(1, min(parts, size // RANGE_MIN_PART)))
+        ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+    else:
+        ranges = [(0, None)]
+    with open(path, 'wb') as f:
+        if size:
+            f.truncate(size)
+    try:
+        await asyncio.gather(*(loop.run_in_executor(range_executor, _fetch_range, url, path, start, end, advance, stop)
+                               for start, end in ranges))
+    finally:
+        stop.set()
+    if size and done[0] != size:
+        raise RuntimeError("تحميل Reel غير مكتمل!")
+    return done[0]
+
+# يُعيد مسار الفيديو ومعلوماته؛ الملف الجزئي يُحذف عند الفشل والمستدعي يحذف الملف المكتمل بعد الإرسال
+async def fetch_reel(shortcode, user_id, on_wait=None):
+    file_path = f"downloads/reel_{shortcode}_{current_job.get()}.mp4"
+    try:
+        async with fetch_slot(user_id, on_wait):
+            reel = await resolve_reel(shortcode)
+            with metrics.timer('stage_seconds', stage='download'):
+                try:
+                    await download_ranges(reel['video_url'], file_path)
+                except requests.HTTPError:
+                    # روابط CDN موقعة ولها مدة صلاحية: حل جديد للرابط مرة واحدة
+                    reel_cache.pop(shortcode)
+                    reel = await resolve_reel(shortcode)
+                    await download_ranges(reel['video_url'], file_path)
         if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
             raise FileNotFoundError("فشل تحميل Reel!")
-        caption = f"🎥 **Reel: {post.caption[:50] + '...' if post.caption else 'بدون عنوان'}**\n@techno_syria_bot"
-        await status_msg.edit("⚡ **جاري إرسال Reel...** ⏳")
-        if os.path.getsize(file_path) / (1024 * 1024) > 50:
-            parts = await split_file(file_path)
-            for i, part in enumerate(parts, 1):
-                await send_file(event.chat_id, part, False, f"📦 **جزء {i}/{len(parts)}**\n{caption}")
-                os.remove(part)
-        else:
-            await send_file(event.chat_id, file_path, False, caption)
-        stats['downloads'] += 1
-        await status_msg.delete()
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    metrics.inc('bytes_total', os.path.getsize(file_path), direction='download')
+    return file_path, reel
+
+def reel_caption(reel):
+    return f"🎥 **Reel: {reel['caption'][:50] + '...' if reel['caption'] else 'بدون عنوان'}**\n@techno_syria_bot"
+
+async def process_instagram_reels(event, status_msg, url):
+    shortcode = re.search(INSTA_REELS_PATTERN, url).group(1)
+    reel_url = normalize_url(f"https://www.instagram.com/reel/{shortcode}/")
+    file_path = None
+    try:
+        with metrics.job('Reels'):
+            async for db in get_db():
+                if await send_cached_media(db, event.chat_id, reel_url, 'reel'):
+                    metrics.inc('deliveries_total', platform='Reels', source='reference')
+                    await outbox.delete(status_msg)
+                    return
+            on_wait = queue_notifier(status_msg)
+            current_progress.set(JobProgress(status_msg))
+            async with platform_adapter('Instagram').run():
+                file_path, reel = await fetch_reel(shortcode, event.sender_id, on_wait)
+                caption = reel_caption(reel)
+                await outbox.edit(status_msg, "⚡ **جاري إرسال Reel...** ⏳")
+                async with scheduler.upload.slot(event.sender_id, on_wait):
+                    messages = await deliver_file(event.chat_id, file_path, False, caption)
+                if messages:
+                    async for db in get_db():
+                        await save_cached_media(db, reel_url, 'reel', messages)
+                metrics.inc('deliveries_total', platform='Reels', source='file')
+            await outbox.delete(status_msg)
     except Exception as e:
-        stats['errors'] += 1
-        await status_msg.edit(f"❌ **فشل تحميل Reel:** {str(e)}\n@techno_syria_bot", 
+        await outbox.edit(status_msg, f"❌ **فشل تحميل Reel:** {str(e)}\n@techno_syria_bot", 
                              buttons=[Button.inline("🔄 حاول مجدداً", f"retry_reels_{url}")])
+        raise
     finally:
-        if file_path and os.path.exists(os.path.dirname(file_path)):
-            shutil.rmtree(os.path.dirname(file_path))
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+# الملفات المرفوعة: تُسجل بمعرف المستند فقط، وتُحمّل عند أول إجراء ثم تُعاد لبقية الإجراءات
+async def register_upload(event, document):
+    async for db in get_db():
+        with metrics.timer('db_seconds', op='register'):
+            await db.execute("INSERT OR REPLACE INTO uploads (doc_id, access_hash, file_reference, size, mime_type, "
+                             "chat_id, msg_id, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (document.id, document.access_hash, document.file_reference, document.size,
+                              document.mime_type, event.chat_id, event.message.id, time.time()))
+            await db.commit()
+
+async def load_upload(doc_id):
+    async for db in get_db():
+        with metrics.timer('db_seconds', op='select'):
+            async with db.execute("SELECT access_hash, file_reference, size, mime_type, chat_id, msg_id FROM uploads "
+                                  "WHERE doc_id=? AND created >= ?", (doc_id, time.time() - UPLOAD_TTL)) as cursor:
+                return await cursor.fetchone()
+
+# النسخة المحلية مسجلة في المخبأ ضمن حصة العامل، وتعود محجوزة: على المستدعي تحريرها بـ cache_store.unpin
+async def fetch_upload(doc_id):
+    row = await load_upload(doc_id)
+    if row is None:
+        raise FileNotFoundError("انتهت صلاحية الملف، أعد إرساله!")
+    access_hash, file_reference, size, mime_type, chat_id, msg_id = row
+    cache_key = f"upload:{doc_id}"
+    file_path = cache_store.get(cache_key)
+    if file_path:
+        if os.path.getsize(file_path) == size:
+            metrics.inc('cache_requests_total', cache='upload', result='hit')
+            return file_path
+        cache_store.unpin(file_path)
+    file_path = f"downloads/upload_{doc_id}_{WORKER_NAME}{mimetypes.guess_extension(mime_type) or ''}"
+    metrics.inc('cache_requests_total', cache='upload', result='miss')
+
+    async def fetch():
+        partial = file_path + '.part'
+        progress = current_progress.get()
+        callback = progress.download_callback if progress else None
+        location = InputDocumentFileLocation(id=doc_id, access_hash=access_hash, file_reference=file_reference,
+                                             thumb_size='')
+        try:
+            with metrics.timer('stage_seconds', stage='download'):
+                try:
+                    await client.download_file(location, partial, file_size=size, progress_callback=callback)
+                except FileReferenceExpiredError:
+                    # مرجع الملف منتهي: الرسالة الأصلية تعطي مرجعاً جديداً
+                    message = await client.get_messages(chat_id, ids=msg_id)
+                    if not message or not message.media:
+                        raise FileNotFoundError("الرسالة الأصلية محذوفة!")
+                    await client.download_media(message, partial, progress_callback=callback)
+            if os.path.getsize(partial) == 0:
+                raise FileNotFoundError("فشل تحميل الملف!")
+            os.replace(partial, file_path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        metrics.inc('bytes_total', size, direction='download')
+        cache_store.put(cache_key, file_path)
+        return file_path
+    async with inflight.join(('upload', doc_id), lambda _: fetch(), cache_store.unpin) as flight:
+        # حجز لكل مستدعٍ قبل أن يحرر آخر المنتظرين حجز التحميل نفسه
+        cache_store.pin(flight.task.result())
+    return file_path
 
 # معالجة الملفات المرفوعة
 @client.on(events.NewMessage(incoming=True))
@@ -440,16 +2410,13 @@ async def handle_message(event):
         file = event.message.media.document
         mime_type = file.mime_type
         if mime_type.startswith('video/') or mime_type.startswith('audio/'):
-            file_path = await client.download_media(event.message, "downloads/uploaded_file")
-            if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-                await event.reply("❌ **فشل رفع الملف!**\n@techno_syria_bot")
-                return
+            await register_upload(event, file)
             buttons = [
-                [Button.inline("📥 ضغط", f"compress_{file_path}"), Button.inline("🎵 MP3", f"mp3_{file_path}")],
-                [Button.inline("🎬 GIF", f"gif_{file_path}"), Button.inline("📂 Drive", f"drive_{file_path}")],
-                [Button.inline("🔗 Telegraph", f"telegraph_{file_path}")]
+                [Button.inline("📥 ضغط", f"compress_{file.id}"), Button.inline("🎵 MP3", f"mp3_{file.id}")],
+                [Button.inline("🎬 GIF", f"gif_{file.id}"), Button.inline("📂 Drive", f"drive_{file.id}")],
+                [Button.inline("🔗 Telegraph", f"telegraph_{file.id}")]
             ]
-            await event.reply(
+            await outbox.reply(event, 
                 "🎥 **اختر خياراً لمعالجة الملف:**\n"
                 "- **ضغط**: تقليل الحجم لتوفير المساحة.\n"
                 "- **MP3**: استخراج الصوت فقط.\n"
@@ -458,103 +2425,282 @@ async def handle_message(event):
                 "- **Telegraph**: رابط سريع للمشاركة.\n@techno_syria_bot",
                 buttons=buttons, parse_mode='markdown'
             )
-    elif re.search(INSTA_REELS_PATTERN, text):
-        await download_instagram_reels(text, event)
-    elif re.search(YT_PATTERN, text):
-        is_playlist = 'playlist' in text.lower() or 'list=' in text
-        await download_media(text, event, 'YouTube', is_playlist=is_playlist)
-    elif re.search(INSTA_PATTERN, text):
-        await download_media(text, event, 'Instagram')
-    elif re.search(TIKTOK_PATTERN, text):
-        await download_media(text, event, 'TikTok')
-    elif re.search(FB_PATTERN, text):
-        await download_media(text, event, 'Facebook')
-    elif re.search(TWITTER_PATTERN, text):
-        await download_media(text, event, 'Twitter')
-    elif re.search(TELEGRAM_STORY_PATTERN, text):
-        await download_media(text, event, 'Telegram')
+    elif routes := route_urls(text):
+        for route, _ in routes:
+            metrics.inc('routed_messages_total', route=route)
+        if len(routes) > 1:
+            await download_batch(routes, event)
+            return
+        route, url = routes[0]
+        if route == 'reels':
+            await download_instagram_reels(url, event)
+        else:
+            await download_media(url, event, ROUTE_PLATFORMS[route], is_playlist=is_playlist_url(route, url))
 
 # معالجة خيارات الملفات
-@client.on(events.CallbackQuery(pattern=r'(compress|mp3|gif|drive|telegraph)_.+'))
+@client.on(events.CallbackQuery(pattern=r'(compress|mp3|gif|drive|telegraph)_-?\d+$'))
 async def process_file_options(event):
-    data = event.data.decode().split('_', 1)
-    action, file_path = data[0], data[1]
-    if not os.path.exists(file_path):
-        await event.reply("❌ **الملف مفقود!**\n@techno_syria_bot")
+    action, doc_id = event.data.decode().split('_', 1)
+    if await load_upload(int(doc_id)) is None:
+        await outbox.reply(event, "❌ **انتهت صلاحية الملف، أعد إرساله!**\n@techno_syria_bot")
         return
-    status_msg = await event.reply(f"⚡ **جاري معالجة الملف ({action})...** ⏳", parse_mode='markdown')
+    status_msg = await outbox.reply(event, f"⚡ **جاري معالجة الملف ({action})...** ⏳", parse_mode='markdown')
+    await enqueue_job('file', event, status_msg, action=action, doc_id=int(doc_id))
+
+async def process_file(event, status_msg, action, doc_id):
+    on_wait = queue_notifier(status_msg)
+    current_progress.set(JobProgress(status_msg))
+    converters = {
+        'compress': (compress_video, "_compressed.mp4", "فشل الضغط!", "🎥 **فيديو مضغوط**"),
+        'mp3': (convert_to_mp3, ".mp3", "فشل تحويل MP3!", "🎵 **صوت MP3**"),
+        'gif': (convert_to_gif, ".gif", "فشل تحويل GIF!", "🎬 **GIF متحرك**"),
+    }
     try:
-        if action == 'compress':
-            output = f"{os.path.splitext(file_path)[0]}_compressed.mp4"
-            success, _ = await compress_video(file_path, output)
-            if not success:
-                raise RuntimeError("فشل الضغط!")
-            caption = f"🎥 **فيديو مضغوط**\n@techno_syria_bot"
-            await send_file(event.chat_id, output, False, caption)
-            os.remove(output)
-        elif action == 'mp3':
-            output = f"{os.path.splitext(file_path)[0]}.mp3"
-            success, _ = await convert_to_mp3(file_path, output)
-            if not success:
-                raise RuntimeError("فشل تحويل MP3!")
-            caption = f"🎵 **صوت MP3**\n@techno_syria_bot"
-            await send_file(event.chat_id, output, False, caption)
-            os.remove(output)
-        elif action == 'gif':
-            output = f"{os.path.splitext(file_path)[0]}.gif"
-            success, _ = await convert_to_gif(file_path, output)
-            if not success:
-                raise RuntimeError("فشل تحويل GIF!")
-            caption = f"🎬 **GIF متحرك**\n@techno_syria_bot"
-            await send_file(event.chat_id, output, False, caption)
-            os.remove(output)
-        elif action == 'drive':
-            link = await upload_to_drive(file_path)
-            await event.reply(f"📂 **رابط Drive:** {link}\n@techno_syria_bot")
-        elif action == 'telegraph':
-            link = await upload_to_telegraph(file_path)
-            await event.reply(f"🔗 **رابط Telegraph:** {link}\n@techno_syria_bot")
-        stats['downloads'] += 1
-        await status_msg.delete()
+        with metrics.job('File'), contextlib.ExitStack() as stack:
+            async with fetch_slot(event.sender_id, on_wait):
+                file_path = await fetch_upload(doc_id)
+            stack.callback(cache_store.unpin, file_path)
+            if action in converters:
+                convert, suffix, error, title = converters[action]
+                output = f"{os.path.splitext(file_path)[0]}_{current_job.get()}{suffix}"
+                try:
+                    async with scheduler.transcode.slot(event.sender_id, on_wait):
+                        success, _ = await convert(file_path, output)
+                    if not success:
+                        raise RuntimeError(error)
+                    async with scheduler.upload.slot(event.sender_id, on_wait):
+                        await deliver_file(event.chat_id, output, False, f"{title}\n@techno_syria_bot")
+                finally:
+                    if os.path.exists(output):
+                        os.remove(output)
+            elif action == 'drive':
+                async with scheduler.upload.slot(event.sender_id, on_wait):
+                    link = await upload_to_drive(file_path)
+                await outbox.reply(event, f"📂 **رابط Drive:** {link}\n@techno_syria_bot")
+            elif action == 'telegraph':
+                async with scheduler.upload.slot(event.sender_id, on_wait):
+                    link = await upload_to_telegraph(file_path)
+                await outbox.reply(event, f"🔗 **رابط Telegraph:** {link}\n@techno_syria_bot")
+            metrics.inc('deliveries_total', platform='File', source=action)
+            await outbox.delete(status_msg)
     except Exception as e:
-        stats['errors'] += 1
-        await status_msg.edit(f"❌ **فشل المعالجة:** {str(e)}\n@techno_syria_bot")
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        await outbox.edit(status_msg, f"❌ **فشل المعالجة:** {str(e)}\n@techno_syria_bot")
+        raise
+
+# الدفعات: كل روابط الرسالة تُجمع في مهمة واحدة، تُجلب بالتوازي ضمن حصة المستخدم العادلة في الطوابير،
+# ثم تُرسل كألبوم واحد (أو ألبومات من 10) بدلاً من رسالة لكل رابط
+async def download_batch(routes, event):
+    if event.sender_id in banned_users:
+        await outbox.reply(event, "❌ **أنت محظور!**\n@techno_syria_bot")
+        return
+    items = [[route, url] for route, url in routes if validate_url(url)]
+    if not items:
+        await outbox.reply(event, "❌ **رابط غير صالح!**\n@techno_syria_bot")
+        return
+    if not check_ffmpeg():
+        await outbox.reply(event, "❌ **خطأ:** FFmpeg غير مثبت!\n@techno_syria_bot")
+        return
+    skipped = max(0, len(items) - BATCH_MAX)
+    items = items[:BATCH_MAX]
+    note = f"\n⚠️ تم تجاهل {skipped} روابط بعد أول {BATCH_MAX}" if skipped else ""
+    status_msg = await outbox.reply(event, f"📦 **جاري تحميل {len(items)} روابط...** ⏳{note}", parse_mode='markdown')
+    await enqueue_job('batch', event, status_msg, items=items, skipped=skipped)
+
+# عنصر الألبوم: مرجع من مخبأ الوسائط إن وُجد، وإلا ملف على القرص يبقى محجوزاً في stack حتى الإرسال
+def cached_ref(rows):
+    return media_ref(*rows[0][:4]) if len(rows) == 1 else None
+
+async def collect_item(route, url, user_id, on_wait, stack):
+    platform = ROUTE_PLATFORMS[route]
+    adapter = platform_adapter(platform)
+    if route == 'reels':
+        shortcode = re.search(INSTA_REELS_PATTERN, url).group(1)
+        key_url, variant = normalize_url(f"https://www.instagram.com/reel/{shortcode}/"), 'reel'
+    else:
+        key_url, variant = adapter.normalize(url), media_variant()
+    async for db in get_db():
+        ref = cached_ref(await get_cached_media(db, key_url, variant))
+    if ref:
+        return key_url, variant, ref, None
+    async with adapter.run():
+        if route == 'reels':
+            file_path, reel = await fetch_reel(shortcode, user_id, on_wait)
+            stack.callback(os.remove, file_path)
+            return key_url, variant, file_path, reel_caption(reel)
+        key = (key_url, 'best', False, False)
+        fetch = lambda on_wait: fetch_media(url, 'best', False, False, media_tag(key), user_id, on_wait, key_url)
+        flight = await stack.enter_async_context(inflight.join(key, fetch, release_fetched, on_wait=on_wait))
+        files, _ = flight.task.result()
+    return key_url, variant, files[0], f"🎥 **{os.path.basename(files[0])}**\n@techno_syria_bot"
+
+async def process_batch(event, status_msg, items, skipped=0):
+    on_wait = queue_notifier(status_msg)
+    limiter = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = [None] * len(items)
+    failed = []
+
+    async def run_item(i, route, url):
+        async with limiter:
+            try:
+                results[i] = await collect_item(route, url, event.sender_id, on_wait, stack)
+            except Exception as e:
+                failed.append(url)
+                metrics.inc('batch_item_errors_total', platform=ROUTE_PLATFORMS[route])
+                logging.warning(f"Batch item failed ({url}): {str(e)}")
+        done = sum(r is not None for r in results)
+        await set_status(status_msg, f"📦 **الدفعة:** ✅ {done} | ❌ {len(failed)} من {len(items)} ⏳")
+
+    try:
+        with metrics.job('Batch'):
+            async with contextlib.AsyncExitStack() as stack:
+                await asyncio.gather(*(run_item(i, route, url) for i, (route, url) in enumerate(items)))
+                ready = [r for r in results if r]
+                if not ready:
+                    raise RuntimeError("فشل تحميل جميع الروابط!")
+                # ما يتجاوز حد الرفع لا يدخل الألبوم ويُرسل مقسماً كالمعتاد
+                oversized = [r for r in ready if isinstance(r[2], str) and os.path.getsize(r[2]) > MAX_UPLOAD_SIZE]
+                album = [r for r in ready if r not in oversized]
+                undelivered = []
+                async with scheduler.upload.slot(event.sender_id, on_wait):
+                    for start in range(0, len(album), BATCH_MAX):
+                        undelivered += await send_album(event.chat_id, album[start:start + BATCH_MAX])
+                    for _, _, file_path, caption in oversized:
+                        if not await deliver_file(event.chat_id, file_path, False, caption):
+                            raise RuntimeError("فشل إرسال الملف!")
+                # ما لم يُرسل (مرجع منتهي، أو ملف فشل إرساله) يُجلب من جديد ويُرسل وحده، وفشله يُحسب على عنصره فقط
+                for entry in undelivered:
+                    route, url = items[results.index(entry)]
+                    try:
+                        key_url, variant, item, caption = await collect_item(route, url, event.sender_id,
+                                                                             on_wait, stack)
+                        async with scheduler.upload.slot(event.sender_id, on_wait):
+                            async for db in get_db():
+                                if isinstance(item, str):
+                                    messages = await deliver_file(event.chat_id, item, False, caption)
+                                    if messages:
+                                        await save_cached_media(db, key_url, variant, messages)
+                                else:
+                                    messages = await send_cached_media(db, event.chat_id, key_url, variant)
+                        if not messages:
+                            raise RuntimeError("فشل إرسال الملف!")
+                    except Exception as e:
+                        failed.append(url)
+                        metrics.inc('batch_item_errors_total', platform=ROUTE_PLATFORMS[route])
+                        logging.warning(f"Batch item failed ({url}): {str(e)}")
+        if failed or skipped:
+            lines = [f"📦 **اكتملت الدفعة:** ✅ {len(items) - len(failed)} | ❌ {len(failed)}"]
+            lines += [f"• {url}" for url in failed]
+            if skipped:
+                lines.append(f"⚠️ تم تجاهل {skipped} روابط بعد أول {BATCH_MAX}")
+            await outbox.edit(status_msg, '\n'.join(lines) + "\n@techno_syria_bot")
+        else:
+            await outbox.delete(status_msg)
+    except Exception as e:
+        await outbox.edit(status_msg, f"❌ **فشل تحميل الدفعة:** {str(e)}\n@techno_syria_bot")
+        raise
+
+# ألبوم واحد: الملفات تُرفع أولاً ثم تُرسل مع المراجع المخزنة كمجموعة. عند فشل الألبوم
+# (مثلاً مرجع منتهي الصلاحية) تُرسل العناصر فرادى بما رُفع منها. يُعيد العناصر التي لم تُرسل
+async def send_album(chat, album):
+    uploads = {}
+    try:
+        for i, (_, _, item, _) in enumerate(album):
+            if isinstance(item, str):
+                uploads[i] = await upload_media(item)
+        media = [uploads.get(i, item) for i, (_, _, item, _) in enumerate(album)]
+        messages = await outbox.send_file(chat, media, caption=[caption or "" for *_, caption in album],
+                                          parse_mode='markdown', supports_streaming=True)
+    except Exception as e:
+        logging.warning(f"Album of {len(album)} failed, sending items one by one: {str(e)}")
+        undelivered = []
+        for i, entry in enumerate(album):
+            key_url, variant, item, caption = entry
+            async for db in get_db():
+                if not isinstance(item, str):
+                    sent = await send_cached_media(db, chat, key_url, variant)
+                elif i in uploads:
+                    # الملف رُفع قبل فشل الألبوم: يُرسل بنفس المقبض بدلاً من رفعه مرة أخرى
+                    try:
+                        msg = await outbox.send_file(chat, uploads[i], caption=caption, parse_mode='markdown',
+                                                     supports_streaming=True)
+                    except Exception as e:
+                        logging.warning(f"Album item {key_url} failed: {str(e)}")
+                        msg = None
+                    if msg:
+                        await save_cached_media(db, key_url, variant, [msg])
+                    sent = msg is not None
+                else:
+                    messages = await deliver_file(chat, item, False, caption)
+                    if messages:
+                        await save_cached_media(db, key_url, variant, messages)
+                    sent = bool(messages)
+            if not sent:
+                undelivered.append(entry)
+        return undelivered
+    metrics.inc('albums_sent_total')
+    async for db in get_db():
+        for (key_url, variant, item, _), msg in zip(album, messages):
+            metrics.inc('deliveries_total', platform='Batch', source='file' if isinstance(item, str) else 'reference')
+            if isinstance(item, str):
+                await save_cached_media(db, key_url, variant, [msg])
+    return []
+
+# البحث في يوتيوب: خارج حلقة الأحداث في مجمع محدود، مع مخبأ للنتائج
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='yt-search')
+search_cache = TTLCache(maxsize=256, ttl=SEARCH_TTL)
+
+def youtube_url(video_id):
+    return normalize_url(f"https://youtube.com/watch?v={video_id}")
+
+def _run_search(query):
+    with yt_dlp.YoutubeDL({**YDL_BASE_OPTS, 'noplaylist': True}) as ydl:
+        return ydl.extract_info(f"ytsearch5:{query}", download=False)['entries']
+
+async def search_youtube(query):
+    key = ' '.join(query.lower().split())
+    results = search_cache.get(key)
+    metrics.inc('cache_requests_total', cache='search', result='miss' if results is None else 'hit')
+    if results is None:
+        async def search():
+            return await asyncio.get_running_loop().run_in_executor(search_executor, _run_search, query)
+        async with inflight.join(('search', key), lambda _: search()) as flight:
+            results = [res for res in flight.task.result() if res]
+        search_cache[key] = results
+        # النتائج كاملة المعلومات تغني أزرار التحميل عن فحص الرابط مجدداً
+        for res in results:
+            probe_cache[youtube_url(res['id'])] = res
+    return results
 
-# البحث في يوتيوب
 @client.on(events.NewMessage(pattern='/yt (.+)'))
 async def youtube_search(event):
     query = event.pattern_match.group(1)
-    ydl_opts = {'quiet': True, 'noplaylist': True, 'cookiefile': COOKIES_PATH}
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            results = ydl.extract_info(f"ytsearch5:{query}", download=False)['entries']
+        with metrics.job('Search'):
+            results = await search_youtube(query)
             if not results:
                 raise ValueError("لا توجد نتائج!")
         buttons = [[Button.inline(f"🎥 {res['title'][:30]}", f"yt_select_{res['id']}")] for res in results]
-        await event.reply(f"🔎 **نتائج البحث:** {query}\n@techno_syria_bot", buttons=buttons, parse_mode='markdown')
+        await outbox.reply(event, f"🔎 **نتائج البحث:** {query}\n@techno_syria_bot", buttons=buttons, parse_mode='markdown')
     except Exception as e:
-        stats['errors'] += 1
-        await event.reply(f"❌ **فشل البحث:** {str(e)}\n@techno_syria_bot")
+        await outbox.reply(event, f"❌ **فشل البحث:** {str(e)}\n@techno_syria_bot")
 
 @client.on(events.CallbackQuery(pattern=r'yt_select_.+'))
 async def select_video(event):
-    video_id = event.data.decode().split('_')[2]
+    video_id = event.data.decode().split('_', 2)[2]
     buttons = [
         [Button.inline("720p", f"dl_yt_{video_id}_720p"), Button.inline("🎵 MP3", f"dl_yt_{video_id}_mp3")],
         [Button.inline("🎬 GIF", f"dl_yt_{video_id}_gif"), Button.inline("📂 Drive", f"dl_yt_{video_id}_drive")]
     ]
-    await event.reply("📏 **اختر خياراً:**\n@techno_syria_bot", buttons=buttons, parse_mode='markdown')
+    info = probe_cache.get(youtube_url(video_id))
+    title = f"🎥 **{info['title']}** ({info.get('duration_string', '?')})\n" if info else ""
+    await outbox.reply(event, f"{title}📏 **اختر خياراً:**\n@techno_syria_bot", buttons=buttons, parse_mode='markdown')
 
 @client.on(events.CallbackQuery(pattern=r'dl_yt_.+'))
 async def download_selected(event):
-    data = event.data.decode().split('_')
-    video_id, option = data[2], data[3]
-    url = f"https://youtube.com/watch?v={video_id}"
+    video_id, option = event.data.decode()[len('dl_yt_'):].rsplit('_', 1)
+    url = youtube_url(video_id)
     format_map = {'720p': 'bestvideo[height<=720]+bestaudio/best[height<=720]', 'mp3': 'bestaudio/best', 'gif': 'bestvideo[height<=720]'}
-    await download_media(url, event, 'YouTube', format_map.get(option, '720p'), 
+    await download_media(url, event, 'YouTube', format_map.get(option, format_map['720p']),
                          audio_only=(option == 'mp3'), to_gif=(option == 'gif'), to_drive=(option == 'drive'))
 
 # إعادة المحاولة
@@ -564,22 +2710,300 @@ async def retry_download(event):
     platform, url = data[1], data[2]
     if platform == 'reels':
         await download_instagram_reels(url, event)
-    else:
-        await download_media(url, event, platform.capitalize())
+    elif platform.lower() in PLATFORMS:
+        await download_media(url, event, platform_adapter(platform).name)
+
+# طابور المهام الدائم: الواجهة تسجل كل مهمة في جدول jobs، والعمال (داخل العملية أو عمليات منفصلة) يحجزونها بعقد مؤقت
+# ويجددونه دورياً. المهمة التي انتهى عقدها (توقف العامل) يحجزها عامل آخر وتُستأنف تلقائياً
+current_job = contextvars.ContextVar('current_job', default=None)
+
+def note_job_stage(stage):
+    progress = current_progress.get()
+    for job_id in progress.job_ids if isinstance(progress, FlightProgress) else [current_job.get()]:
+        if job_id is not None:
+            db_writes.add("UPDATE jobs SET stage=?, updated=? WHERE id=?", (stage, time.time(), job_id))
+
+# بدائل لحدث Telegram ورسالة الحالة يعيد العامل بناءها من صف المهمة
+class JobEvent:
+    def __init__(self, chat_id, sender_id, reply_to=None):
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.reply_to = reply_to
+
+    async def reply(self, text, **kwargs):
+        return await client.send_message(self.chat_id, text, reply_to=self.reply_to, **kwargs)
+
+class StatusMessage:
+    def __init__(self, chat_id, msg_id):
+        self.chat_id = chat_id
+        self.id = msg_id
+
+    async def edit(self, text, **kwargs):
+        return await client.edit_message(self.chat_id, self.id, text, **kwargs)
+
+    async def delete(self):
+        return await client.delete_messages(self.chat_id, [self.id])
+
+async def enqueue_job(kind, event, status_msg, **payload):
+    reply_to = getattr(event, 'message_id', None) or event.message.id
+    now = time.time()
+    async for db in get_db():
+        with metrics.timer('db_seconds', op='enqueue'):
+            cursor = await db.execute("INSERT INTO jobs (kind, chat_id, sender_id, reply_to, status_id, payload, state, "
+                                      "created, updated) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                                      (kind, event.chat_id, event.sender_id, reply_to, status_msg.id,
+                                       json.dumps(payload), now, now))
+            await db.commit()
+    metrics.inc('jobs_enqueued_total', kind=kind)
+    job_worker.wake()
+    return cursor.lastrowid
+
+async def cancel_jobs(sender_id):
+    async for db in get_db():
+        # RETURNING تُقرأ في نفس الاستدعاء: عبارة كتابة مفتوحة على الاتصال المشترك تمنع أي commit آخر
+        rows = await db.execute_fetchall("UPDATE jobs SET state='cancelled', updated=? WHERE sender_id=? AND state IN "
+                                         "('queued', 'running') RETURNING id, chat_id, status_id, worker",
+                                         (time.time(), sender_id))
+        await db.commit()
+    for job_id, chat_id, status_id, worker in rows:
+        # المهام التي لم يحجزها أي عامل تُغلق هنا، والجارية يوقفها عاملها عند فحصه التالي
+        if worker is None:
+            await outbox.edit(StatusMessage(chat_id, status_id), "🛑 **تم الإلغاء!**\n@techno_syria_bot")
+    job_worker.cancel_local([row[0] for row in rows])
+    return rows
+
+class JobWorker:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self._tasks = {}
+        self._cancelled = set()
+        self._lost = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def cancel_local(self, job_ids, lost=False):
+        for job_id in job_ids:
+            if job_id in self._tasks:
+                (self._lost if lost else self._cancelled).add(job_id)
+                self._tasks[job_id].cancel()
+
+    async def start(self):
+        async for db in get_db():
+            # مهام هذا العامل من تشغيل سابق انقطع: تعود للطابور فوراً بدلاً من انتظار انتهاء العقد
+            await db.execute("UPDATE jobs SET state='queued', worker=NULL, lease_until=NULL WHERE state='running' AND worker=?",
+                             (self.name,))
+            await db.commit()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        renewed = time.monotonic()
+        while True:
+            self._wakeup.clear()
+            try:
+                async for db in get_db():
+                    if len(self._tasks) < self.concurrency:
+                        for row in await self._claim(db, self.concurrency - len(self._tasks)):
+                            self._tasks[row[0]] = asyncio.create_task(self._execute(row))
+                    if self._tasks:
+                        renew = time.monotonic() - renewed >= JOB_LEASE / 3
+                        await self._heartbeat(db, renew)
+                        if renew:
+                            renewed = time.monotonic()
+            except aiosqlite.Error as e:
+                logging.error(f"Job worker {self.name} failed to poll: {str(e)}")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+
+    async def _claim(self, db, limit):
+        now = time.time()
+        # الحجز عبارة UPDATE واحدة فلا يحجز عاملان نفس المهمة. الأولوية لأصحاب أقل عدد من المهام الجارية ثم للأقدم
+        rows = await db.execute_fetchall(
+            "UPDATE jobs SET state='running', worker=?, lease_until=?, attempts=attempts+1, updated=? WHERE id IN "
+            "(SELECT id FROM jobs AS j WHERE state='queued' OR (state='running' AND lease_until<?) ORDER BY "
+            "(SELECT COUNT(*) FROM jobs WHERE sender_id=j.sender_id AND state='running'), id LIMIT ?) "
+            "RETURNING id, kind, chat_id, sender_id, reply_to, status_id, payload, attempts",
+            (self.name, now + JOB_LEASE, now, now, limit))
+        await db.commit()
+        return rows
+
+    async def _heartbeat(self, db, renew):
+        ids = list(self._tasks)
+        marks = ','.join('?' * len(ids))
+        async with db.execute(f"SELECT id, state, worker FROM jobs WHERE id IN ({marks})", ids) as cursor:
+            rows = await cursor.fetchall()
+        self.cancel_local([job_id for job_id, state, _ in rows if state == 'cancelled'])
+        # عقد انتهى وحجزه عامل آخر: نتوقف بصمت حتى لا تُنفذ المهمة مرتين
+        self.cancel_local([job_id for job_id, state, worker in rows if state == 'running' and worker != self.name],
+                          lost=True)
+        if renew:
+            await db.execute(f"UPDATE jobs SET lease_until=? WHERE worker=? AND state='running' AND id IN ({marks})",
+                             (time.time() + JOB_LEASE, self.name, *ids))
+            await db.commit()
+
+    async def _execute(self, row):
+        job_id, kind, chat_id, sender_id, reply_to, status_id, payload, attempts = row
+        event, status_msg = JobEvent(chat_id, sender_id, reply_to), StatusMessage(chat_id, status_id)
+        current_job.set(job_id)
+        state, error = 'done', None
+        try:
+            if attempts > MAX_JOB_ATTEMPTS:
+                state, error = 'failed', "توقفت المهمة عدة مرات!"
+                await outbox.edit(status_msg, f"❌ **فشل التنفيذ:** {error}\n@techno_syria_bot")
+            else:
+                if attempts > 1:
+                    await set_status(status_msg, "🔄 **استئناف المهمة بعد إعادة التشغيل...** ⏳")
+                await JOB_KINDS[kind](event, status_msg, **json.loads(payload))
+        except asyncio.CancelledError:
+            if job_id in self._cancelled:
+                state = 'cancelled'
+                await outbox.edit(status_msg, "🛑 **تم الإلغاء!**\n@techno_syria_bot")
+            elif job_id in self._lost:
+                state = None
+            else:
+                # إيقاف العامل: المهمة تعود للطابور دون احتساب المحاولة
+                state = 'queued'
+        except Exception as e:
+            state, error = 'failed', str(e)
+            logging.error(f"Job {job_id} ({kind}) failed: {error}")
+        finally:
+            self._tasks.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            self._lost.discard(job_id)
+            self._wakeup.set()
+        if state:
+            await self._finish(job_id, state, error)
+
+    async def _finish(self, job_id, state, error=None):
+        async for db in get_db():
+            if state == 'queued':
+                await db.execute("UPDATE jobs SET state='queued', worker=NULL, lease_until=NULL, attempts=attempts-1, "
+                                 "updated=? WHERE id=? AND worker=? AND state='running'", (time.time(), job_id, self.name))
+            else:
+                await db.execute("UPDATE jobs SET state=?, error=?, lease_until=NULL, updated=? WHERE id=? AND worker=?",
+                                 (state, error, time.time(), job_id, self.name))
+            await db.commit()
+
+JOB_KINDS = {'media': process_download, 'reel': process_instagram_reels, 'file': process_file, 'batch': process_batch}
+job_worker = JobWorker(WORKER_NAME, JOB_CONCURRENCY)
+
+# عمليات العمال: تُعاد تشغيلها إذا توقفت، وتُنهى مع البوت
+async def supervise_worker(index):
+    env = {**os.environ, 'WORKER_ID': str(index)}
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        logging.warning(f"Worker {index} exited with code {code}, restarting...")
+        await asyncio.sleep(5)
+
+# نقطة /metrics بصيغة Prometheus على عنوان محلي
+async def serve_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request.decode(errors='ignore').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def scrape_metrics(port):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(METRICS_HOST, port), timeout=2)
+    try:
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout=5)
+    finally:
+        writer.close()
+    head, _, body = response.decode(errors='ignore').partition('\r\n\r\n')
+    if ' 200 ' not in head.split('\r\n')[0]:
+        raise ConnectionError(head.split('\r\n')[0])
+    return body
+
+# مقاييس كل العمليات معاً: الواجهة وحدها لا تنفذ أي مهمة حين JOB_WORKERS > 0. يعيد النسخة المجمعة وعدد العمال غير المتاحين
+async def cluster_metrics():
+    combined = Metrics(metrics.prefix)
+    combined.load(metrics.render())
+    ports = [METRICS_PORT + index for index in range(1, JOB_WORKERS + 1)] if METRICS_PORT and WORKER_ID is None else []
+    results = await asyncio.gather(*(scrape_metrics(port) for port in ports), return_exceptions=True)
+    missing = 0
+    for port, result in zip(ports, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Metrics scrape on port {port} failed: {str(result) or type(result).__name__}")
+            missing += 1
+        else:
+            combined.load(result)
+    if JOB_WORKERS and not METRICS_PORT:
+        missing = JOB_WORKERS
+    return combined, missing
 
 # بدء البوت
 async def main():
     async for db in get_db():
         await init_db(db)
+        await cache_store.load(db)
     if not check_ffmpeg():
         logging.error("FFmpeg missing! Exiting...")
         exit(1)
     if not check_cookies():
         logging.warning("Cookies missing! YouTube may fail.")
     await client.start(bot_token=bot_token)
-    print(f"@techno_syria_bot is live! 🚀")
-    asyncio.create_task(periodic_cleanup())
-    await client.run_until_disconnected()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(client.disconnect()))
+    supervisors = []
+    if WORKER_ID is None:
+        print(f"@techno_syria_bot is live! 🚀")
+        asyncio.create_task(periodic_cleanup())
+        supervisors = [asyncio.create_task(supervise_worker(i)) for i in range(1, JOB_WORKERS + 1)]
+    else:
+        logging.info(f"Job worker {WORKER_NAME} started")
+    if WORKER_ID is not None or not JOB_WORKERS:
+        await job_worker.start()
+    metrics_server = None
+    metrics_port = METRICS_PORT + int(WORKER_ID) if METRICS_PORT and WORKER_ID else METRICS_PORT
+    if metrics_port:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, metrics_port)
+        logging.info(f"Metrics on http://{METRICS_HOST}:{metrics_port}/metrics")
+    startup['ready'] = time.perf_counter() - BOOT_STARTED
+    logging.info(f"Startup: import {startup['import']:.2f}s, ready {startup['ready']:.2f}s")
+    try:
+        await client.run_until_disconnected()
+    finally:
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        await job_worker.stop()
+        if metrics_server:
+            metrics_server.close()
+        await close_db()
+
+startup['import'] = time.perf_counter() - BOOT_STARTED
 
 if __name__ == '__main__':
     asyncio.run(main())